@@ -0,0 +1,131 @@
+"""
+Micro-benchmarks for the compendium and rendering hot paths. Run from the api directory:
+
+    python -m benchmarks [-o results.json] [--compare baseline.json] [--threshold 0.1]
+
+Each result is the best per-iteration time over several repeats, in seconds. --compare exits with 1 if any benchmark got
+slower than the baseline by more than the threshold.
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import sys
+import timeit
+
+from lib.compendium import CATEGORY_SOURCES, Compendium, Snapshot, SNAPSHOT_PATH
+from lib.rendering import _render, parse_data_formatting, render, render_cache
+from .formatting import load_corpus
+from .rendering import collect_entries
+
+
+def bench(func, repeat, number=1):
+    times = timeit.repeat(func, number=number, repeat=repeat)
+    return {'seconds': min(times) / number, 'mean': sum(times) / len(times) / number, 'repeat': repeat}
+
+
+def bench_load(results, repeat):
+    for source, path in (('json', None), ('snapshot', SNAPSHOT_PATH)):
+        if source == 'snapshot':
+            try:
+                Snapshot(path)
+            except (OSError, ValueError):
+                continue
+        for name in CATEGORY_SOURCES:
+            def load():
+                getattr(Compendium(snapshot_path=path), name)
+
+            results[f"load.{source}.{name}"] = bench(load, repeat)
+
+
+def bench_render(results, c, repeat):
+    strings = load_corpus()
+    entries = collect_entries()
+    results['parse_data_formatting.corpus'] = bench(lambda: [parse_data_formatting(s) for s in strings], repeat)
+    results['render.uncached'] = bench(lambda: [_render(e, b) for e, b in entries], repeat)
+    render_cache.clear()
+    [render(e, b) for e, b in entries]
+    results['render.cached'] = bench(lambda: [render(e, b) for e, b in entries], repeat)
+
+    def traits():
+        render_cache.clear()
+        for race in c.fancyraces:
+            race.get_traits()
+
+    results['race.get_traits'] = bench(traits, repeat)
+
+
+def bench_spells(results, c, repeat):
+    results['spell.to_dict'] = bench(lambda: [s.to_dict() for s in c.spells], repeat)
+    results['spell.to_dict_json'] = bench(lambda: [json.dumps(s.to_dict()) for s in c.spells], repeat)
+
+
+def bench_plans(results, c, repeat):
+    from dicecloud_tools.autochar import build_plan  # plan building never talks to Dicecloud
+
+    race, background = c.fancyraces[0], c.backgrounds[0]
+    for level in (1, 10, 20):
+        def plans():
+            render_cache.clear()
+            for _class in c.classes:
+                subclass = _class['subclasses'][0] if _class.get('subclasses') else {'subclassFeatures': []}
+                build_plan(level, race, _class, subclass, background)
+
+        results[f"plan.level{level}"] = bench(plans, repeat)
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"{'benchmark':<36}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:<36}{'-':>12}{result['seconds'] * 1000:>10.3f}ms{'new':>9}")
+            continue
+        change = result['seconds'] / old['seconds'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' !'
+        print(f"{name:<36}{old['seconds'] * 1000:>10.3f}ms{result['seconds'] * 1000:>10.3f}ms{change:>+8.1%}{flag}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {threshold:.0%}: {', '.join(regressions)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the compendium and rendering hot paths.")
+    parser.add_argument('-o', '--output', help="Write results to this JSON file.")
+    parser.add_argument('--compare', help="Compare against a results file saved by an earlier run.")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Slowdown that counts as a regression.")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.getLogger('lib.rendering').setLevel(logging.ERROR)
+    c = Compendium()
+    results = {}
+    bench_load(results, args.repeat)
+    bench_render(results, c, args.repeat)
+    bench_spells(results, c, args.repeat)
+    bench_plans(results, c, args.repeat)
+
+    out = {
+        'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                 'time': datetime.datetime.now(datetime.timezone.utc).isoformat()},
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        return 1 if compare(results, baseline, args.threshold) else 0
+    for name, result in sorted(results.items()):
+        print(f"{name:<36}{result['seconds'] * 1000:>10.3f}ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Benchmarks parse_data_formatting against the previous regex-rescan implementation over every string in the
+compendium's static JSON. Run from the api directory: python -m benchmarks.formatting
+
+Strings without nested tags must match the previous implementation exactly. The previous loop paired an outer tag with
+the first closing brace, so nested tags came out mis-paired ({@b A {@i B} C} -> **A *B** C*); they are now resolved
+inside-out, and nested strings are checked against NESTED_CASES and against the same rescan restricted to innermost
+tags.
+"""
+import json
+import logging
+import os
+import re
+import sys
+import timeit
+
+from lib.compendium import STATIC_DIR
+from lib.rendering import FORMATTING, PARSING, parse_data_formatting
+
+SOURCES = ('races.json', 'classes.json', 'classfeats.json', 'spells.json', 'items.json', 'backgrounds.json')
+LEGACY_TAG = re.compile(r'{@(\w+) (.+?)}')
+INNERMOST_TAG = re.compile(r'{@(\w+) ((?:(?!{@)[^}\n])+)}')  # a tag with no tag inside it
+NESTED = re.compile(r'{@\w+ [^{}\n]*{@')
+
+# (text, expected output) for nested markup, which the legacy implementation mis-paired
+NESTED_CASES = (
+    ('{@b A {@i B} C}', '**A *B* C**'),
+    ('{@b {@i {@spell fire bolt|phb}}}', '***fire bolt***'),
+    ('{@i see {@creature goblin|mm|goblins} and {@item rope|phb}}', '*see goblins and rope*'),
+    ('{@b {@i x}', '{@b *x*'),
+    ('{@b {@i x}}}', '***x***}'),
+    ('{@b a\n{@i b}}', '{@b a\n*b*}'),
+)
+
+
+def legacy_parse_data_formatting(text, exp=LEGACY_TAG):
+    def sub(match):
+        if match.group(1) in PARSING:
+            f = PARSING.get(match.group(1), lambda e: e)
+            return f(match.group(2))
+        else:
+            f = FORMATTING.get(match.group(1), '')
+            return f"{f}{match.group(2)}{f}"
+
+    while exp.search(text):
+        text = exp.sub(sub, text)
+    return text
+
+
+def innermost_parse_data_formatting(text):
+    """The legacy rescan, but only ever matching innermost tags: the reference for nested strings."""
+    return legacy_parse_data_formatting(text, INNERMOST_TAG)
+
+
+def expected(text):
+    if NESTED.search(text):
+        return innermost_parse_data_formatting(text)
+    return legacy_parse_data_formatting(text)
+
+
+def collect_strings(obj, out):
+    if isinstance(obj, str):
+        if '{@' in obj:
+            out.append(obj)
+    elif isinstance(obj, list):
+        for v in obj:
+            collect_strings(v, out)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            collect_strings(v, out)
+    return out
+
+
+def load_corpus():
+    strings = []
+    for filename in SOURCES:
+        path = os.path.join(STATIC_DIR, filename)
+        if os.path.exists(path):
+            with open(path) as f:
+                collect_strings(json.load(f), strings)
+    return strings
+
+
+def main(repeat=5):
+    logging.getLogger('lib.rendering').setLevel(logging.ERROR)  # unknown tags would warn on every call
+    strings = load_corpus()
+    if not strings:
+        print(f"No formatted strings found in {STATIC_DIR}")
+        return 1
+    nested = [s for s in strings if NESTED.search(s)]
+    mismatched = [s for s in strings if parse_data_formatting(s) != expected(s)]
+    mismatched += [text for text, out in NESTED_CASES if parse_data_formatting(text) != out]
+
+    legacy = min(timeit.repeat(lambda: [legacy_parse_data_formatting(s) for s in strings], number=1, repeat=repeat))
+    current = min(timeit.repeat(lambda: [parse_data_formatting(s) for s in strings], number=1, repeat=repeat))
+    print(f"{len(strings)} formatted strings ({len(nested)} with nested tags)")
+    print(f"legacy:  {legacy * 1000:.2f}ms")
+    print(f"current: {current * 1000:.2f}ms ({legacy / current:.1f}x)")
+    print(f"mismatches: {len(mismatched)}")
+    for s in mismatched[:10]:
+        print(f"  {s!r}")
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Checks the render engine against the previous recursive implementation for identical output on every entry in
+classes.json and races.json, and compares their throughput. Run from the api directory: python -m benchmarks.rendering
+"""
+import json
+import logging
+import os
+import sys
+import timeit
+
+from lib.compendium import STATIC_DIR
+from lib.rendering import ABILITY_MAP, _render, parse_data_formatting
+
+log = logging.getLogger(__name__)
+
+
+def legacy_render(text, md_breaks=False):
+    if not isinstance(text, list):
+        return parse_data_formatting(str(text))
+
+    out = []
+    join_str = '\n' if not md_breaks else '  \n'
+
+    for entry in text:
+        if not isinstance(entry, dict):
+            out.append(str(entry))
+        elif isinstance(entry, dict):
+            if not 'type' in entry and 'title' in entry:
+                out.append(f"**{entry['title']}**: {legacy_render(entry['text'])}")
+            elif not 'type' in entry and 'istable' in entry:  # only for races
+                temp = f"**{entry['caption']}**\n" if 'caption' in entry else ''
+                temp += ' - '.join(f"**{cl}**" for cl in entry['thead']) + '\n'
+                for row in entry['tbody']:
+                    temp += ' - '.join(f"{col}" for col in row) + '\n'
+                out.append(temp.strip())
+            elif not 'type' in entry:
+                out.append((f"**{entry['name']}**: " if 'name' in entry else '') +
+                           legacy_render(entry['entries']))
+            elif entry['type'] == 'entries':
+                out.append((f"**{entry['name']}**: " if 'name' in entry else '') + legacy_render(
+                    entry['entries']))  # oh gods here we goooooooo
+            elif entry['type'] == 'item':
+                out.append((f"**{entry['name']}**: " if 'name' in entry else '') + legacy_render(
+                    entry['entry']))  # oh gods here we goooooooo
+            elif entry['type'] == 'options':
+                pass  # parsed separately in classfeat
+            elif entry['type'] == 'list':
+                out.append('\n'.join(f"- {legacy_render([t])}" for t in entry['items']))
+            elif entry['type'] == 'table':
+                temp = f"**{entry['caption']}**\n" if 'caption' in entry else ''
+                temp += ' - '.join(f"**{cl}**" for cl in entry['colLabels']) + '\n'
+                for row in entry['rows']:
+                    temp += ' - '.join(f"{col}" for col in row) + '\n'
+                out.append(temp.strip())
+            elif entry['type'] == 'invocation':
+                pass  # this is only found in options
+            elif entry['type'] == 'abilityAttackMod':
+                out.append(f"`{entry['name']} Attack Bonus = "
+                           f"{' or '.join(ABILITY_MAP.get(a) for a in entry['attributes'])}"
+                           f" modifier + Proficiency Bonus`")
+            elif entry['type'] == 'abilityDc':
+                out.append(f"`{entry['name']} Save DC = 8 + "
+                           f"{' or '.join(ABILITY_MAP.get(a) for a in entry['attributes'])}"
+                           f" modifier + Proficiency Bonus`")
+            elif entry['type'] == 'bonus':
+                out.append("{:+}".format(entry['value']))
+            elif entry['type'] == 'dice':
+                if 'toRoll' in entry:
+                    out.append(' + '.join(f"{d['number']}d{d['faces']}" for d in entry['toRoll']))
+                else:
+                    out.append(f"{entry['number']}d{entry['faces']}")
+            elif entry['type'] == 'bonusSpeed':
+                out.append(f"{entry['value']} feet")
+            else:
+                log.warning(f"Missing entry type parse: {entry}")
+        else:
+            log.warning(f"Unknown entry: {entry}")
+
+    return parse_data_formatting(join_str.join(out))
+
+
+def collect_entries():
+    """Returns every (entries, md_breaks) pair that the app renders from classes.json and races.json."""
+    cases = []
+    with open(os.path.join(STATIC_DIR, 'races.json')) as f:
+        for race in json.load(f):
+            cases.append((race['entries'], False))
+            for entry in race['entries']:
+                if isinstance(entry, dict) and 'name' in entry:
+                    cases.append((entry['entries'], False))
+    with open(os.path.join(STATIC_DIR, 'classes.json')) as f:
+        for _class in json.load(f):
+            for table in _class.get('classTableGroups', []):
+                for row in table['rows']:
+                    cases.extend(([col], False) for col in row)
+            for level_features in _class['classFeatures']:
+                cases.extend((feature['entries'], True) for feature in level_features)
+            for subclass in _class.get('subclasses', []):
+                for level_features in subclass.get('subclassFeatures', []):
+                    for feature in level_features:
+                        cases.append((feature.get('entries', []), True))
+    return cases
+
+
+def main(repeat=5):
+    logging.getLogger('lib.rendering').setLevel(logging.ERROR)
+    log.setLevel(logging.ERROR)
+    cases = collect_entries()
+    mismatched = [e for e, md_breaks in cases if _render(e, md_breaks) != legacy_render(e, md_breaks)]
+
+    legacy = min(timeit.repeat(lambda: [legacy_render(e, b) for e, b in cases], number=1, repeat=repeat))
+    current = min(timeit.repeat(lambda: [_render(e, b) for e, b in cases], number=1, repeat=repeat))
+    print(f"{len(cases)} entries")
+    print(f"legacy:  {legacy * 1000:.2f}ms")
+    print(f"current: {current * 1000:.2f}ms ({legacy / current:.2f}x)")
+    print(f"mismatches: {len(mismatched)}")
+    for e in mismatched[:10]:
+        print(f"  {e!r}"[:200])
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,13 @@
+import copy
+import os
+import time
+
+from lib.cache import LRUCache
+from lib.compendium import subclass_features
 from lib.dicecloud.client import DicecloudClient
 from lib.dicecloud.models import Class, Effect, Feature, Parent, Proficiency
 from lib.rendering import ABILITY_MAP, render
+from lib.tracing import Phases, span
 
 SKILL_MAP = {'acrobatics': 'acrobatics', 'animal handling': 'animalHandling', 'arcana': 'arcana',
              'athletics': 'athletics', 'deception': 'deception', 'history': 'history', 'initiative': 'initiative',
@@ -15,21 +22,50 @@ CLASS_RESOURCE_NAMES = {"Ki Points": "ki", "Rage Damage": "rageDamage", "Rages":
                         "4th": "level4SpellSlots", "5th": "level5SpellSlots", "6th": "level6SpellSlots",
                         "7th": "level7SpellSlots", "8th": "level8SpellSlots", "9th": "level9SpellSlots"}
 
+PLAN_CACHE_SIZE = int(os.environ.get("PLAN_CACHE_SIZE", 512))
+
+CHAR_ID = '$charId'
+CLASS_ID = '$classId'
+
+plan_cache = LRUCache(PLAN_CACHE_SIZE)
+
+
+class CharacterPlan:
+    """The features, effects, and proficiencies for a character build, before it has a character or class ID."""
+
+    def __init__(self, level, race_name, class_name, background_name, features, effects, proficiencies):
+        self.level = level
+        self.race_name = race_name
+        self.class_name = class_name
+        self.background_name = background_name
+        self.features = features
+        self.effects = effects
+        self.proficiencies = proficiencies
+
+    def bind(self, char_id, class_id):
+        """Returns copies of (features, effects, proficiencies) parented to the given IDs."""
+        ids = {CHAR_ID: char_id, CLASS_ID: class_id}
+
+        def rebind(obj):
+            obj = copy.copy(obj)
+            obj.parent = Parent(ids[obj.parent.id], obj.parent.collection, obj.parent.group)
+            return obj
 
-def create_char(api_key, name, level, race, _class, subclass, background):
+        return self.features, [rebind(e) for e in self.effects], [rebind(p) for p in self.proficiencies]
+
+
+def build_plan(level, race, _class, subclass, background):
+    """
+    Builds everything create_char inserts for a character, without talking to Dicecloud.
+    Effects and proficiencies are parented to placeholder IDs that CharacterPlan.bind fills in.
+    """
     # things to add in batches
     effects = []
     features = []
     profs_to_add = []
 
     caveats = []  # a to do list for the user
-
-    # setup client
-    dc = DicecloudClient(None, None, api_key, no_meteor=True)
-
-    # Name Gen + Setup
-    #    DMG name gen
-    char_id = dc.create_character(name=name, race=race.name, backstory=background.name)
+    phases = Phases()
 
     # Stat Gen
     # Allow user to enter base values
@@ -38,15 +74,16 @@ def create_char(api_key, name, level, race, _class, subclass, background):
 
     # Race Gen
     #    Racial Features
+    phases.start('race')
     speed = race.get_speed_int()
     if speed:
-        effects.append(Effect(Parent.race(char_id), 'base', value=int(speed), stat='speed'))
+        effects.append(Effect(Parent.race(CHAR_ID), 'base', value=int(speed), stat='speed'))
 
     for k, v in race.ability.items():
         if not k == 'choose':
-            effects.append(Effect(Parent.race(char_id), 'add', value=int(v), stat=ABILITY_MAP[k].lower()))
+            effects.append(Effect(Parent.race(CHAR_ID), 'add', value=int(v), stat=ABILITY_MAP[k].lower()))
         else:
-            effects.append(Effect(Parent.race(char_id), 'add', value=int(v[0].get('amount', 1))))
+            effects.append(Effect(Parent.race(CHAR_ID), 'add', value=int(v[0].get('amount', 1))))
             caveats.append(
                 f"**Racial Ability Bonus ({int(v[0].get('amount', 1)):+})**: In your race (Journal tab), select the"
                 f" score you want a bonus to (choose {v[0]['count']} from {', '.join(v[0]['from'])}).")
@@ -58,28 +95,28 @@ def create_char(api_key, name, level, race, _class, subclass, background):
 
     # Class Gen
     #    Class Features
-    class_id = dc.insert_class(char_id, Class(level, _class['name']))
-    effects.append(Effect(Parent.class_(class_id), 'add', stat=f"d{_class['hd']['faces']}HitDice",
+    phases.start('class')
+    effects.append(Effect(Parent.class_(CLASS_ID), 'add', stat=f"d{_class['hd']['faces']}HitDice",
                           calculation=f"{_class['name']}Level"))
 
     hp_per_level = (int(_class['hd']['faces']) / 2) + 1
     first_level_hp = int(_class['hd']['faces']) - hp_per_level
-    effects.append(Effect(Parent.class_(class_id), 'add', stat='hitPoints',
+    effects.append(Effect(Parent.class_(CLASS_ID), 'add', stat='hitPoints',
                           calculation=f"{hp_per_level}*{_class['name']}Level+{first_level_hp}"))
     caveats.append("**HP**: HP is currently calculated using class average; change the value in the Journal tab "
                    "under your class if you wish to change it.")
 
     for saveProf in _class['proficiency']:
         prof_key = ABILITY_MAP.get(saveProf).lower() + 'Save'
-        profs_to_add.append(Proficiency(Parent.class_(class_id), prof_key, type_='save'))
+        profs_to_add.append(Proficiency(Parent.class_(CLASS_ID), prof_key, type_='save'))
     for prof in _class['startingProficiencies'].get('armor', []):
-        profs_to_add.append(Proficiency(Parent.class_(class_id), prof, type_='armor'))
+        profs_to_add.append(Proficiency(Parent.class_(CLASS_ID), prof, type_='armor'))
     for prof in _class['startingProficiencies'].get('weapons', []):
-        profs_to_add.append(Proficiency(Parent.class_(class_id), prof, type_='weapon'))
+        profs_to_add.append(Proficiency(Parent.class_(CLASS_ID), prof, type_='weapon'))
     for prof in _class['startingProficiencies'].get('tools', []):
-        profs_to_add.append(Proficiency(Parent.class_(class_id), prof, type_='tool'))
+        profs_to_add.append(Proficiency(Parent.class_(CLASS_ID), prof, type_='tool'))
     for _ in range(int(_class['startingProficiencies']['skills']['choose'])):
-        profs_to_add.append(Proficiency(Parent.class_(class_id), type_='skill'))  # add placeholders
+        profs_to_add.append(Proficiency(Parent.class_(CLASS_ID), type_='skill'))  # add placeholders
     caveats.append(f"**Skill Proficiencies**: You get to choose your skill proficiencies. Under your class "
                    f"in the Journal tab, you may select {_class['startingProficiencies']['skills']['choose']} "
                    f"skills from {', '.join(_class['startingProficiencies']['skills']['from'])}.")
@@ -92,17 +129,22 @@ def create_char(api_key, name, level, race, _class, subclass, background):
                      f"{gold_alt}"
     caveats.append(f"**Starting Class Equipment**: {starting_items}")
 
+    phases.start('features')
     level_resources = {}
     for table in _class.get('classTableGroups', []):
-        relevant_row = table['rows'][level - 1]
+        # compiled compendiums carry pre-rendered text; loaded straight from JSON, it is rendered here
+        if 'renderedRows' in table:
+            relevant_row = table['renderedRows'][level - 1]
+        else:
+            relevant_row = [render([col]) for col in table['rows'][level - 1]]
         for i, col in enumerate(relevant_row):
-            level_resources[table['colLabels'][i]] = render([col])
+            level_resources[table['colLabels'][i]] = col
 
     for res_name, res_value in level_resources.items():
         stat_name = CLASS_RESOURCE_NAMES.get(res_name)
         if stat_name:
             try:
-                effects.append(Effect(Parent.class_(class_id), 'base', value=int(res_value), stat=stat_name))
+                effects.append(Effect(Parent.class_(CLASS_ID), 'base', value=int(res_value), stat=stat_name))
             except ValueError:  # edge case: level 20 barb rage
                 pass
 
@@ -112,19 +154,15 @@ def create_char(api_key, name, level, race, _class, subclass, background):
         for f in level_features:
             if f.get('gainSubclassFeature'):
                 num_subclass_features += 1
-            text = render(f['entries'], True)
+            text = f['rendered'] if 'rendered' in f else render(f['entries'], True)
             features.append(Feature(f['name'], text))
     for num in range(num_subclass_features):
-        level_features = subclass['subclassFeatures'][num]
-        for feature in level_features:
-            for entry in feature.get('entries', []):
-                if not isinstance(entry, dict):
-                    continue
-                if not entry.get('type') == 'entries':
-                    continue
-                fe = {'name': entry['name'],
-                      'text': render(entry['entries'], True)}
-                features.append(Feature(fe['name'], fe['text']))
+        if 'renderedFeatures' in subclass:
+            level_features = subclass['renderedFeatures'][num]
+        else:
+            level_features = subclass_features(subclass['subclassFeatures'][num])
+        for fe in level_features:
+            features.append(Feature(fe['name'], fe['text']))
     caveats.append("**Class Features**: Check that the number of uses for each feature is correct, and apply "
                    "any effects they grant.")
     caveats.append("**Spellcasting**: If your class can cast spells, be sure to set your number of known spells, "
@@ -133,6 +171,7 @@ def create_char(api_key, name, level, race, _class, subclass, background):
 
     # Background Gen
     #    Inventory/Trait Gen
+    phases.start('background')
     for trait in background.traits:
         text = trait['text']
         if any(i in trait['name'].lower() for i in ('proficiency', 'language')):
@@ -146,29 +185,83 @@ def create_char(api_key, name, level, race, _class, subclass, background):
     for proftype, profs in background.proficiencies.items():
         if proftype == 'tool':
             for prof in profs:
-                profs_to_add.append(Proficiency(Parent.background(char_id), prof, type_='tool'))
+                profs_to_add.append(Proficiency(Parent.background(CHAR_ID), prof, type_='tool'))
         elif proftype == 'skill':
             for prof in profs:
                 dc_prof = SKILL_MAP.get(prof, prof)
                 if dc_prof:
-                    profs_to_add.append(Proficiency(Parent.background(char_id), dc_prof))
+                    profs_to_add.append(Proficiency(Parent.background(CHAR_ID), dc_prof))
                 else:
-                    profs_to_add.append(Proficiency(Parent.background(char_id)))
+                    profs_to_add.append(Proficiency(Parent.background(CHAR_ID)))
                     caveats.append(f"**Choose Skill**: Your background gives you proficiency in either {prof}. "
                                    f"Choose this in the Background section of the Persona tab.")
         elif proftype == 'language':
             for prof in profs:
-                profs_to_add.append(Proficiency(Parent.background(char_id), prof, type_='language'))
+                profs_to_add.append(Proficiency(Parent.background(CHAR_ID), prof, type_='language'))
             caveats.append("**Languages**: Some backgrounds' languages may ask you to choose one or more. Fill "
                            "this out in the Background section of the Persona tab.")
 
     features.append(
         Feature("!!! Caveats !!!", "**__Caveats__**  \nNot everything is automagical! Here are some things you still "
                                    "have to do manually:  \n" + '\n\n'.join(caveats)))
+    phases.end()
+
+    return CharacterPlan(level, race.name, _class['name'], background.name, features, effects, profs_to_add)
+
+
+def compile_plan(level, race, _class, subclass, background):
+    """
+    Returns the plan for a build, building it only the first time the build is seen. Plans are shared between
+    characters, so they must not be modified; CharacterPlan.bind returns copies of anything it changes.
+    Builds are told apart by the identity of their compendium objects, so a reloaded compendium never reuses plans
+    built from the one it replaced.
+    """
+    if plan_cache.maxsize <= 0:
+        return build_plan(level, race, _class, subclass, background)
+    sources = (race, _class, subclass, background)
+    key = (*map(id, sources), level)
+    cached = plan_cache.get(key)
+    if cached is not None:
+        return cached[1]
+    plan = build_plan(level, race, _class, subclass, background)
+    plan_cache.set(key, (sources, plan))  # holding the sources keeps their IDs from being reused while cached
+    return plan
+
+
+def create_char(api_key, name, level, race, _class, subclass, background, progress=None, plan=None, budget=None):
+    """
+    Creates a character on Dicecloud and returns its ID.
+    :param progress: (callable) If passed, called with the name of each stage as it starts.
+    :param plan: (CharacterPlan) A plan already built for these arguments, to skip building it again.
+    :param budget: (float) If passed, the most seconds all of the Dicecloud calls together may take.
+    :raises DeadlineExceeded: if the budget runs out.
+    """
+    deadline = time.monotonic() + budget if budget is not None else None
+    if progress is None:
+        progress = lambda stage: None
+
+    if plan is None:
+        progress('building features')
+        plan = compile_plan(level, race, _class, subclass, background)
+
+    # setup client
+    dc = DicecloudClient(None, None, api_key, no_meteor=True, deadline=deadline)
+
+    # Name Gen + Setup
+    #    DMG name gen
+    progress('creating character')
+    with span('create_character'):
+        char_id = dc.create_character(name=name, race=plan.race_name, backstory=plan.background_name)
+
+    progress('inserting class')
+    with span('insert_class'):
+        class_id = dc.insert_class(char_id, Class(plan.level, plan.class_name))
 
-    dc.insert_features(char_id, features)
-    dc.insert_effects(char_id, effects)
-    dc.insert_proficiencies(char_id, profs_to_add)
+    progress('inserting features, effects, and proficiencies')
+    with span('insert_all'):
+        features, effects, profs = plan.bind(char_id, class_id)
+        # these only depend on char_id and class_id, so they can all go at once
+        dc.insert_all(char_id, features=features, effects=effects, proficiencies=profs)
 
     return char_id
 
@@ -0,0 +1,47 @@
+# gunicorn -c gunicorn.conf.py web:app
+import gc
+import logging
+import os
+import signal
+
+from lib.memory import memory_usage
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+
+# Load the compendium categories the app serves once in the master and fork workers from it. Their objects are moved
+# out of the garbage collector's generations first, so collections in the workers don't write to (and un-share) those
+# pages.
+preload_app = bool(int(os.environ.get("GUNICORN_PRELOAD", 1)))
+
+log = logging.getLogger("gunicorn.error")
+
+
+def when_ready(server):
+    if preload_app:
+        from lib.compendium import c
+        c.load_all(c.preload)  # the app is already imported, and has set the categories it serves
+        gc.collect()
+        gc.freeze()
+    from lib.metrics import registry
+    registry.retire()  # files left by processes of a previous run
+    log.info(f"Master memory before fork (kB): {memory_usage()}")
+
+
+def post_fork(server, worker):
+    log.info(f"Worker {worker.pid} memory after fork (kB): {memory_usage()}")
+
+
+def post_worker_init(worker):
+    # `kill -HUP <worker pid>` reloads that worker's compendium (HUP to the master replaces the workers instead)
+    from lib.compendium import c
+    signal.signal(signal.SIGHUP, lambda signum, frame: c.reload_in_background())
+
+
+def worker_exit(server, worker):
+    log.info(f"Worker {worker.pid} memory at exit (kB): {memory_usage()}")
+
+
+def child_exit(server, worker):
+    # runs in the master once the worker is gone: keep its counters, drop its gauges and its file
+    from lib.metrics import registry
+    registry.retire(worker.pid)
@@ -0,0 +1,61 @@
+import collections
+import threading
+
+
+class LRUCache:
+    """A bounded, thread-safe LRU cache. Subclasses can override ``fresh`` to expire entries, and ``evicted`` to see
+    what falls out of it."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if not self.fresh(value):
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self.evicted(*self._data.popitem(last=False))
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def fresh(self, value):
+        """Whether a stored value may still be returned. Called holding the cache's lock."""
+        return True
+
+    def evicted(self, key, value):
+        """Called, holding the cache's lock, with each entry pushed out to make room."""
+
+    def values(self):
+        with self._lock:
+            return list(self._data.values())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
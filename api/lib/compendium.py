@@ -1,21 +1,57 @@
+import contextvars
+import hashlib
 import json
+import logging
+import mmap
+import os
+import pickle
 import re
+import sys
+import threading
+import time
 
 from lib.rendering import render
 
+STATIC_DIR = './static'
+SNAPSHOT_PATH = os.environ.get("COMPENDIUM_SNAPSHOT", os.path.join(STATIC_DIR, 'compendium.snapshot'))
+WATCH_INTERVAL = float(os.environ.get("COMPENDIUM_WATCH_INTERVAL", 10))  # seconds between source checks; 0 disables
+
+SCHOOLS = {
+    "A": "Abjuration",
+    "V": "Evocation",
+    "E": "Enchantment",
+    "I": "Illusion",
+    "D": "Divination",
+    "N": "Necromancy",
+    "T": "Transmutation",
+    "C": "Conjuration"
+}
+COMBAT_DURATION_RE = re.compile(r"(?:Concentration, up to )?(\d+) (\w+)")
+MATERIAL_RE = re.compile(r'\(([^()]+)\)')
+
+log = logging.getLogger(__name__)
+
+
+def _intern(value):
+    """Interns strings that repeat across the compendium (sources, schools, class names), so workers share one copy."""
+    return sys.intern(value) if isinstance(value, str) else value
+
 
 class Race:
+    __slots__ = ('name', 'source', 'page', 'size', 'speed', 'ability', 'entries', 'srd', 'darkvision', '_traits')
+
     def __init__(self, name: str, source: str, page: int, size: str, speed, asi, entries, srd: bool = False,
                  darkvision: int = 0):
         self.name = name
-        self.source = source
+        self.source = _intern(source)
         self.page = page
-        self.size = size
+        self.size = _intern(size)
         self.speed = speed
         self.ability = asi
         self.entries = entries
         self.srd = srd
         self.darkvision = darkvision
+        self._traits = None
 
     @classmethod
     def from_data(cls, data):
@@ -47,6 +83,8 @@ class Race:
         return ', '.join(ability)
 
     def get_traits(self):
+        if self._traits is not None:  # pre-rendered by the compendium compiler
+            return self._traits
         traits = []
         for entry in self.entries:
             if isinstance(entry, dict) and 'name' in entry:
@@ -57,6 +95,10 @@ class Race:
 
 
 class Spell:
+    __slots__ = ('name', 'level', 'school', 'classes', 'subclasses', 'time', 'range', 'components', 'duration',
+                 'ritual', 'description', 'higherlevels', 'source', 'page', 'concentration', 'automation', 'srd',
+                 'image', '_json')
+
     def __init__(self, name: str, level: int, school: str, casttime: str, range_: str, components: str, duration: str,
                  description: str, classes=None, subclasses=None, ritual: bool = False, higherlevels: str = None,
                  source: str = "homebrew", page: int = None, concentration: bool = False, automation=None,
@@ -71,22 +113,23 @@ class Spell:
             subclasses = [cls.strip() for cls in subclasses.split(',') if cls.strip()]
         self.name = name
         self.level = level
-        self.school = school
-        self.classes = classes
-        self.subclasses = subclasses
-        self.time = casttime
-        self.range = range_
+        self.school = _intern(school)
+        self.classes = [_intern(cls) for cls in classes]
+        self.subclasses = [_intern(cls) for cls in subclasses]
+        self.time = _intern(casttime)
+        self.range = _intern(range_)
         self.components = components
         self.duration = duration
         self.ritual = ritual
         self.description = description
         self.higherlevels = higherlevels
-        self.source = source
+        self.source = _intern(source)
         self.page = page
         self.concentration = concentration
         self.automation = automation
         self.srd = srd
         self.image = image
+        self._json = None
 
         if self.concentration and 'Concentration' not in self.duration:
             self.duration = f"Concentration, up to {self.duration}"
@@ -98,16 +141,7 @@ class Spell:
         return cls(**data)
 
     def get_school(self):
-        return {
-            "A": "Abjuration",
-            "V": "Evocation",
-            "E": "Enchantment",
-            "I": "Illusion",
-            "D": "Divination",
-            "N": "Necromancy",
-            "T": "Transmutation",
-            "C": "Conjuration"
-        }.get(self.school, self.school)
+        return SCHOOLS.get(self.school, self.school)
 
     def get_level(self):
         if self.level == 0:
@@ -121,7 +155,7 @@ class Spell:
         return f"{self.level}th level"
 
     def get_combat_duration(self):
-        match = re.match(r"(?:Concentration, up to )?(\d+) (\w+)", self.duration)
+        match = COMBAT_DURATION_RE.match(self.duration)
         if match:
             num = int(match.group(1))
             unit = match.group(2)
@@ -133,7 +167,7 @@ class Spell:
         return -1
 
     def to_dict(self):
-        mat = re.search(r'\(([^()]+)\)', self.components)
+        mat = MATERIAL_RE.search(self.components)
         text = self.description.replace('\n', '  \n')
         if self.higherlevels:
             text += f"\n\n**At Higher Levels**: {self.higherlevels}"
@@ -155,13 +189,45 @@ class Spell:
             'prepared': 'prepared'
         }
 
+    def to_json(self):
+        """The spell's Dicecloud payload as encoded JSON, serialized once and reused for every insert."""
+        if self._json is None:
+            self._json = json.dumps(self.to_dict()).encode()
+        return self._json
+
+
+def subclass_features(level_features):
+    """The named ``entries`` entries of one level's subclass features, rendered as {'name', 'text'} features."""
+    features = []
+    for feature in level_features:
+        for entry in feature.get('entries', []):
+            if not isinstance(entry, dict):
+                continue
+            if not entry.get('type') == 'entries':
+                continue
+            features.append({'name': entry['name'], 'text': render(entry['entries'], True)})
+    return features
+
+
+def _prerender_class(_class):
+    """Stores the rendered text of a class's table cells and class/subclass features alongside their entries."""
+    for table in _class.get('classTableGroups', []):
+        table['renderedRows'] = [[render([col]) for col in row] for row in table['rows']]
+    for level_features in _class['classFeatures']:
+        for f in level_features:
+            f['rendered'] = render(f['entries'], True)
+    for subclass in _class.get('subclasses', []):
+        subclass['renderedFeatures'] = [subclass_features(lf) for lf in subclass.get('subclassFeatures', [])]
+
 
 class Background:
+    __slots__ = ('name', 'traits', 'proficiencies', 'source', 'page', 'srd')
+
     def __init__(self, name, traits, proficiencies, source, page, srd):
         self.name = name
         self.traits = traits
         self.proficiencies = proficiencies
-        self.source = source
+        self.source = _intern(source)
         self.page = page
         self.srd = srd
 
@@ -170,39 +236,381 @@ class Background:
         return cls(**raw)
 
 
+class category:
+    """Marks a Compendium method as the loader for a lazily-loaded category."""
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.name = loader.__name__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.load(self.name, self.loader)
+        instance.__dict__[self.name] = value  # later lookups skip the descriptor
+        return value
+
+
+class Snapshot:
+    """
+    A compiled compendium: each category parsed, normalized, and pre-rendered (see compile()).
+
+    The file is memory-mapped so that loading a category reads only that category's bytes, and so that a process keeps
+    reading the file it opened after a new snapshot is renamed over it. This only speeds up loading: each category is
+    unpickled into ordinary objects on the loading process's heap, so nothing is shared through the mapping. Workers
+    share memory only by forking from a master that preloaded the compendium (see gunicorn.conf.py).
+
+    Layout: ``MAGIC``, an 8-byte header length, a JSON header mapping each category to its source file's content hash
+    (plus its size and mtime, to skip hashing files that haven't been touched) and the (offset, length) of its pickled
+    data, then the pickled data. ``MAGIC`` changes whenever what the compiler produces does.
+    """
+    MAGIC = b'CPSNAP2\n'
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buf[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"{path} is not a compendium snapshot from this version")
+        start = len(self.MAGIC) + 8
+        header_len = int.from_bytes(self.buf[len(self.MAGIC):start], 'little')
+        self.header = json.loads(self.buf[start:start + header_len])
+        self.data_start = start + header_len
+
+    def is_fresh(self, name):
+        """Whether the category was compiled from its source file's current contents."""
+        entry = self.header.get(name)
+        if entry is None:
+            return False
+        try:
+            st = os.stat(_source_path(name))
+        except OSError:
+            return False
+        if (st.st_size, st.st_mtime_ns) == (entry['size'], entry['mtime']):
+            return True
+        return _source_hash(name) == entry['hash']  # e.g. a checkout or copy that changed only the mtime
+
+    def raw(self, name):
+        entry = self.header[name]
+        offset = self.data_start + entry['offset']
+        return self.buf[offset:offset + entry['length']]
+
+    def get(self, name):
+        """Returns the compiled category, or None if it is missing or its source file has changed."""
+        if not self.is_fresh(name):
+            return None
+        return pickle.loads(self.raw(name))
+
+    @classmethod
+    def build(cls, path, previous=None):
+        """
+        Compiles the compendium into a snapshot at ``path``. Categories whose source file has the same content hash as
+        in ``previous`` (an older Snapshot) are copied from it instead of being compiled again.
+        Returns the names of the categories that were compiled.
+        """
+        compendium = Compendium(snapshot_path=None)
+        header = {}
+        blobs = []
+        compiled = []
+        offset = 0
+        for name in CATEGORY_SOURCES:
+            st = os.stat(_source_path(name))
+            source_hash = _source_hash(name)
+            old = previous.header.get(name) if previous is not None else None
+            if old is not None and old['hash'] == source_hash:
+                blob = previous.raw(name)
+            else:
+                blob = pickle.dumps(compendium.compile(name), pickle.HIGHEST_PROTOCOL)
+                compiled.append(name)
+            header[name] = {'source': CATEGORY_SOURCES[name], 'hash': source_hash, 'size': st.st_size,
+                            'mtime': st.st_mtime_ns, 'offset': offset, 'length': len(blob)}
+            blobs.append(blob)
+            offset += len(blob)
+        header = json.dumps(header).encode()
+        # written beside the old snapshot and renamed over it, since running processes may have the old one mapped
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmp_path, path)
+        return compiled
+
+
+CATEGORY_SOURCES = {
+    'fancyraces': 'races.json', 'rfeats': 'races.json', 'classes': 'classes.json', 'cfeats': 'classfeats.json',
+    'spells': 'spells.json', 'items': 'items.json', 'backgrounds': 'backgrounds.json'
+}
+
+
+def _source_path(name):
+    return os.path.join(STATIC_DIR, CATEGORY_SOURCES[name])
+
+
+def _source_hash(name):
+    with open(_source_path(name), 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def source_version():
+    """A short hash of every source file's name, size, and mtime, which changes whenever any of them does."""
+    h = hashlib.blake2b(digest_size=6)
+    for filename in sorted(set(CATEGORY_SOURCES.values())):
+        try:
+            st = os.stat(os.path.join(STATIC_DIR, filename))
+        except OSError:
+            h.update(f"{filename}:missing;".encode())
+        else:
+            h.update(f"{filename}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()
+
+
+def _load_json(filename):
+    with open(os.path.join(STATIC_DIR, filename), 'r') as f:
+        return json.load(f)
+
+
 class Compendium:
-    def __init__(self):
-        with open('./static/races.json', 'r') as f:
-            _raw = json.load(f)
-            self.rfeats = []
-            self.fancyraces = [Race.from_data(r) for r in _raw]
-            for race in _raw:
-                for entry in race['entries']:
-                    if isinstance(entry, dict) and 'name' in entry:
-                        temp = {'name': "{}: {}".format(race['name'], entry['name']),
-                                'text': render(entry['entries']), 'srd': race['srd']}
-                        self.rfeats.append(temp)
-        with open('./static/classes.json', 'r') as f:
-            self.classes = json.load(f)
-        with open('./static/classfeats.json') as f:
-            self.cfeats = json.load(f)
-        with open('./static/spells.json', 'r') as f:
-            self.spells = [Spell.from_data(r) for r in json.load(f)]
-        with open('./static/items.json', 'r') as f:
-            _items = json.load(f)
-            self.items = [i for i in _items if i.get('type') is not '$']
-        with open('./static/backgrounds.json', 'r') as f:
-            self.backgrounds = [Background.from_data(b) for b in json.load(f)]
-        self.subclasses = self.load_subclasses()
-
-    def load_subclasses(self):
-        s = []
-        for _class in self.classes:
-            subclasses = _class.get('subclasses', [])
-            for sc in subclasses:
+    """
+    Each data category is loaded from the snapshot (if one exists and is fresh) or parsed from JSON on first access.
+    ``load_times`` records how long each category took to load, in seconds, and ``version`` identifies the source files
+    it was loaded from.
+    """
+
+    def __init__(self, snapshot_path=SNAPSHOT_PATH):
+        self.version = source_version()
+        self.loaded_at = time.time()
+        self.load_times = {}
+        self._lock = threading.RLock()
+        self.snapshot = None
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                self.snapshot = Snapshot(snapshot_path)
+            except (OSError, ValueError):
+                log.warning(f"Could not open compendium snapshot {snapshot_path}, falling back to JSON")
+
+    def load(self, name, loader):
+        with self._lock:
+            if name in self.__dict__:
+                return self.__dict__[name]
+            start = time.perf_counter()
+            value = self.snapshot.get(name) if self.snapshot is not None else None
+            source = 'snapshot'
+            if value is None:
+                value = loader(self)
+                source = 'json'
+            self.load_times[name] = time.perf_counter() - start
+            log.info(f"Loaded compendium {name} from {source} in {self.load_times[name] * 1000:.1f}ms")
+            return value
+
+    @category
+    def fancyraces(self):
+        return [Race.from_data(r) for r in _load_json('races.json')]
+
+    @category
+    def rfeats(self):
+        rfeats = []
+        for race in _load_json('races.json'):
+            for entry in race['entries']:
+                if isinstance(entry, dict) and 'name' in entry:
+                    temp = {'name': "{}: {}".format(race['name'], entry['name']),
+                            'text': render(entry['entries']), 'srd': race['srd']}
+                    rfeats.append(temp)
+        return rfeats
+
+    @category
+    def classes(self):
+        classes = _load_json('classes.json')
+        for _class in classes:
+            _class['name'] = _intern(_class['name'])
+            if 'source' in _class:
+                _class['source'] = _intern(_class['source'])
+            for sc in _class.get('subclasses', []):
                 sc['name'] = f"{_class['name']}: {sc['name']}"
-            s.extend(subclasses)
-        return s
+                if 'source' in sc:
+                    sc['source'] = _intern(sc['source'])
+        return classes
+
+    @category
+    def cfeats(self):
+        return _load_json('classfeats.json')
+
+    @category
+    def spells(self):
+        spells = [Spell.from_data(r) for r in _load_json('spells.json')]
+        for spell in spells:
+            spell.to_json()  # serialized up front so snapshots carry the payloads too
+        return spells
+
+    @category
+    def items(self):
+        return [i for i in _load_json('items.json') if i.get('type') is not '$']
+
+    @category
+    def backgrounds(self):
+        return [Background.from_data(b) for b in _load_json('backgrounds.json')]
+
+    @category
+    def subclasses(self):
+        return [sc for _class in self.classes for sc in _class.get('subclasses', [])]
+
+    def load_all(self, names=CATEGORY_SOURCES):
+        """Loads the given categories (by default, every one) now instead of on first use."""
+        for name in names:
+            getattr(self, name)
+
+    def compile(self, name):
+        """Returns a category with everything derivable from it ahead of time (rendered text) filled in."""
+        value = getattr(self, name)
+        if name == 'fancyraces':
+            for race in value:
+                race._traits = race.get_traits()
+        elif name == 'classes':
+            for _class in value:
+                _prerender_class(_class)
+        return value
+
+    def prewarm_render_cache(self):
+        """Renders every race trait, class table cell, and class/subclass feature into the render cache."""
+        for race in self.fancyraces:
+            race.get_traits()
+        for _class in self.classes:
+            for table in _class.get('classTableGroups', []):
+                for row in table['rows']:
+                    for col in row:
+                        render([col])
+            for level_features in _class['classFeatures']:
+                for f in level_features:
+                    render(f['entries'], True)
+            for subclass in _class.get('subclasses', []):
+                for level_features in subclass.get('subclassFeatures', []):
+                    for feature in level_features:
+                        for entry in feature.get('entries', []):
+                            if isinstance(entry, dict) and entry.get('type') == 'entries':
+                                render(entry['entries'], True)
+
+
+_pinned = contextvars.ContextVar('compendium', default=None)
+
+
+class Derived:
+    """A value computed from the compendium, recomputed the first time it is used with a new version."""
+
+    def __init__(self, live, build):
+        self.live = live
+        self.build = build
+        self.values = {}  # version -> value; the previous version is kept for requests still pinned to it
+        self.lock = threading.Lock()
+
+    def get(self):
+        compendium = self.live.current
+        value = self.values.get(compendium.version)
+        if value is None:
+            with self.lock:
+                value = self.values.get(compendium.version)
+                if value is None:
+                    value = self.build(compendium)
+                    self.values = {v: self.values[v] for v in list(self.values)[-1:]}
+                    self.values[compendium.version] = value
+        return value
+
+
+class LiveCompendium:
+    """
+    The current compendium. A loaded Compendium is never changed: reload() loads a new one in the background and swaps
+    it in whole. Attributes are read from the compendium pinned to the current context by pin(), so a request sees a
+    single version throughout, or else from the latest one.
+    """
+
+    def __init__(self, compendium):
+        self.latest = compendium
+        self.listeners = []
+        self.preload = tuple(CATEGORY_SOURCES)  # categories loaded before a new compendium is swapped in or forked
+        self._reload_lock = threading.Lock()
+        self._watcher_pid = None
+        self._watcher_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.current, name)
+
+    @property
+    def current(self):
+        return _pinned.get() or self.latest
+
+    def pin(self):
+        """Pins the latest compendium to the current context. Returns a token to pass to unpin()."""
+        return _pinned.set(self.latest)
+
+    def unpin(self, token):
+        _pinned.reset(token)
+
+    def derived(self, build):
+        """Returns a Derived value: build(compendium), cached per version."""
+        return Derived(self, build)
+
+    def on_swap(self, func):
+        """Registers func(compendium) to be called after a new compendium is swapped in."""
+        self.listeners.append(func)
+        return func
+
+    def reload(self):
+        """Loads and swaps in a new compendium if the source files have changed. Returns whether it did."""
+        with self._reload_lock:
+            if source_version() == self.latest.version:
+                return False
+            compendium = Compendium()
+            compendium.load_all(self.preload)
+            old, self.latest = self.latest, compendium
+        log.info(f"Reloaded compendium: version {old.version} -> {compendium.version}")
+        for func in self.listeners:
+            func(compendium)
+        return True
+
+    def reload_in_background(self):
+        threading.Thread(target=self._try_reload, name='compendium-reload', daemon=True).start()
+
+    def _try_reload(self):
+        try:
+            self.reload()
+        except Exception:  # e.g. a source file caught halfway through being written; the next check tries again
+            log.exception(f"Failed to reload compendium, keeping version {self.latest.version}")
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """Starts a thread that reloads the compendium whenever its source files change, once per process."""
+        if interval <= 0 or self._watcher_pid == os.getpid():
+            return
+        with self._watcher_lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self._try_reload()
+
+        threading.Thread(target=loop, name='compendium-watch', daemon=True).start()
+
+
+c = LiveCompendium(Compendium())
 
+if __name__ == '__main__':
+    # compiles the compendium into a snapshot, recompiling only categories whose sources changed:
+    # python -m lib.compendium [path] [--full]
+    # re-imported so pickled objects reference lib.compendium rather than __main__
+    import lib.compendium as compendium
 
-c = Compendium()
+    args = [a for a in sys.argv[1:] if a != '--full']
+    out = args[0] if args else SNAPSHOT_PATH
+    previous = None
+    if '--full' not in sys.argv and os.path.exists(out):
+        try:
+            previous = compendium.Snapshot(out)
+        except (OSError, ValueError) as e:
+            print(f"Not reusing {out}: {e}")
+    start = time.perf_counter()
+    compiled = compendium.Snapshot.build(out, previous)
+    print(f"Wrote compendium snapshot to {out} in {time.perf_counter() - start:.2f}s "
+          f"(compiled: {', '.join(compiled) or 'nothing'})")
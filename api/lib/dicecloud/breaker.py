@@ -0,0 +1,96 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+FAILURE_THRESHOLD = float(os.environ.get("DICECLOUD_BREAKER_THRESHOLD", 0.5))  # failure rate that opens the circuit
+MIN_CALLS = int(os.environ.get("DICECLOUD_BREAKER_MIN_CALLS", 10))  # calls in the window before it can open
+WINDOW = float(os.environ.get("DICECLOUD_BREAKER_WINDOW", 30))  # seconds of outcomes considered
+COOLDOWN = float(os.environ.get("DICECLOUD_BREAKER_COOLDOWN", 15))  # seconds open before a probe is let through
+
+log = logging.getLogger(__name__)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """
+    Fails calls to an upstream fast while it is unhealthy.
+    Closed, it lets every call through and tracks their outcomes over a rolling window; once the failure rate crosses
+    the threshold it opens and rejects everything. After a cooldown it is half-open: a single probe call is let
+    through, which closes the circuit if it succeeds or opens it again if it fails.
+    """
+
+    def __init__(self, name, threshold=FAILURE_THRESHOLD, min_calls=MIN_CALLS, window=WINDOW, cooldown=COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.opened_at = 0
+        self.probing = False
+        self.outcomes = collections.deque()  # (time, ok)
+        self.lock = threading.Lock()
+        # stats
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """Returns whether a call may be made now. Every allowed call must be followed by a record()."""
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = 'half_open'
+                self.probing = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok):
+        with self.lock:
+            now = time.monotonic()
+            if self.state == 'half_open':
+                self.probing = False
+                if ok:
+                    log.warning(f"{self.name} circuit closed")
+                    self.state = 'closed'
+                    self.outcomes.clear()
+                else:
+                    self._open(now)
+                return
+            if self.state == 'open':  # a call that started before the circuit opened
+                return
+            self.outcomes.append((now, ok))
+            while self.outcomes[0][0] < now - self.window:
+                self.outcomes.popleft()
+            failures = sum(1 for _, o in self.outcomes if not o)
+            if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.threshold:
+                self._open(now)
+
+    def _open(self, now):
+        log.warning(f"{self.name} circuit opened")
+        self.state = 'open'
+        self.opened_at = now
+        self.opened += 1
+        self.outcomes.clear()
+
+    def stats(self):
+        return {'state': self.state, 'opened': self.opened, 'rejected': self.rejected}
+
+
+def get_breaker(upstream):
+    with _breakers_lock:
+        if upstream not in _breakers:
+            _breakers[upstream] = CircuitBreaker(upstream)
+        return _breakers[upstream]
+
+
+def breaker_stats():
+    with _breakers_lock:
+        return {name: breaker.stats() for name, breaker in _breakers.items()}
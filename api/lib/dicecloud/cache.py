@@ -0,0 +1,21 @@
+import time
+
+from ..cache import LRUCache
+
+
+class TTLCache(LRUCache):
+    """A bounded, thread-safe LRU cache whose entries expire ``ttl`` seconds after they are set."""
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key):
+        item = super().get(key)  # (expires, value)
+        return item[1] if item is not None else None
+
+    def set(self, key, value):
+        super().set(key, (time.monotonic() + self.ttl, value))
+
+    def fresh(self, item):
+        return item[0] >= time.monotonic()
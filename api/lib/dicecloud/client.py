@@ -1,62 +1,75 @@
+import contextvars
 import logging
 import os
 import sys
-import time
+import threading
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
-from MeteorClient import MeteorClient
-
-from .errors import InsertFailure, LoginFailure
+from .cache import TTLCache
+from .errors import ConcurrentInsertFailure, InsertFailure, NotFound
 from .http import DicecloudHTTP
+from .meteor import get_connection
 
 TESTING = (os.environ.get("TESTING", False) or 'test' in sys.argv)
-API_BASE = "https://v1.dicecloud.com"
-SOCKET_BASE = "wss://v1.dicecloud.com/websocket"
+API_BASE = os.environ.get("DICECLOUD_API_BASE", "https://v1.dicecloud.com")
+INSERT_WORKERS = int(os.environ.get("DICECLOUD_INSERT_WORKERS", 8))
+CACHE_TTL = float(os.environ.get("DICECLOUD_CACHE_TTL", 300))
+CACHE_SIZE = int(os.environ.get("DICECLOUD_CACHE_SIZE", 1024))
 
 log = logging.getLogger(__name__)
 
+# keyed by (api key, character id); list_id_cache holds {spell list name: list ID} for each character
+character_cache = TTLCache(CACHE_SIZE, CACHE_TTL)
+list_id_cache = TTLCache(CACHE_SIZE, CACHE_TTL)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the process-wide thread pool that runs concurrent Dicecloud calls (recreated after a fork)."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=INSERT_WORKERS, thread_name_prefix='dicecloud')
+            _executor_pid = os.getpid()
+        return _executor
+
 
 class DicecloudClient:
-    instance = None
     user_id = None
 
-    def __init__(self, username, password, api_key, debug=False, no_meteor=False):
+    def __init__(self, username, password, api_key, debug=False, no_meteor=False, deadline=None):
+        """
+        :param deadline: (float) A time.monotonic() time after which no more HTTP API calls are made; calls that would
+            run past it raise DeadlineExceeded.
+        """
         self.username = username
         self.encoded_password = password.encode() if password else None
-        if not no_meteor:
-            self.meteor_client = MeteorClient(SOCKET_BASE, debug=debug)
-        else:
-            self.meteor_client = None
-        self.http = DicecloudHTTP(API_BASE, api_key, debug=debug)
-        self.logged_in = False
+        # every client for the same account shares one Meteor connection per process
+        self.meteor = get_connection(username, self.encoded_password, debug=debug) if not no_meteor else None
+        self.http = DicecloudHTTP(API_BASE, api_key, debug=debug, deadline=deadline)
+        self.api_key = api_key
         self.debug = debug
 
+    @property
+    def meteor_client(self):
+        return self.meteor.client if self.meteor is not None else None
+
+    @property
+    def logged_in(self):
+        return self.meteor is not None and self.meteor.logged_in
+
     def initialize(self):
-        if self.meteor_client is None:
+        """Waits until the shared Meteor connection is logged in, connecting it if this is its first use.
+        :raises LoginFailure: if it could not log in in time."""
+        if self.meteor is None:
             log.info(f"Initialized without Meteor.")
             return
-        log.info(f"Initializing Dicecloud Meteor client (debug={TESTING})")
-        self.meteor_client.connect()
-        loops = 0
-        while (not self.meteor_client.connected) and loops < 100:
-            time.sleep(0.1)
-            loops += 1
-        log.info(f"Connected to Dicecloud in {loops/10} seconds")
-
-        def on_login(error, data):
-            if data:
-                type(self).user_id = data.get('id')
-                self.logged_in = True
-            else:
-                log.warning(error)
-                raise LoginFailure()
-
-        self.meteor_client.login(self.username, self.encoded_password, callback=on_login)
-        loops = 0
-        while not self.logged_in and loops < 100:
-            time.sleep(0.1)
-            loops += 1
-        log.info(f"Logged in as {self.user_id}")
+        self.meteor.wait_ready()
+        type(self).user_id = self.meteor.user_id
 
     def ensure_connected(self):
         if self.logged_in:  # everything is fine:tm:
@@ -69,6 +82,11 @@ class DicecloudClient:
         :param list_name: (str) The name of the spell list to look for. Returns default if not passed.
         :return: (str) The default list id.
         """
+        key = (self.api_key, character_id)
+        list_name_key = list_name.lower() if list_name else None
+        list_ids = list_id_cache.get(key) or {}  # list name (None for the default) -> list ID
+        if list_name_key in list_ids:
+            return list_ids[list_name_key]
         char = self.get_character(character_id)
         if list_name:
             spell_list = next((l for l in char.get('spellLists', []) if l['name'].lower() == list_name.lower()), None)
@@ -76,10 +94,22 @@ class DicecloudClient:
             spell_list = next((l for l in char.get('spellLists', [])), None)
         if not spell_list:
             raise InsertFailure("No spell list found on sheet.")
+        list_id_cache.set(key, {**list_ids, list_name_key: spell_list['_id']})
         return spell_list['_id']
 
+    def _invalidate(self, char_id, list_ids=False):
+        """Drops the cached character document (and optionally its spell list IDs) after a write."""
+        character_cache.pop((self.api_key, char_id))
+        if list_ids:
+            list_id_cache.pop((self.api_key, char_id))
+
     def get_character(self, char_id):
-        return self.http.get(f'/character/{char_id}/json')
+        key = (self.api_key, char_id)
+        char = character_cache.get(key)
+        if char is None:
+            char = self.http.get(f'/character/{char_id}/json')
+            character_cache.set(key, char)
+        return char
 
     def add_spell(self, character, spell):
         """Adds a spell to the dicecloud list."""
@@ -94,7 +124,15 @@ class DicecloudClient:
         list_id = self._get_list_id(character_id, spell_list)
         if not list_id:  # still
             raise InsertFailure("No matching spell lists on origin sheet.")
-        return self.http.post(f'/api/character/{character_id}/spellList/{list_id}', [s.to_dict() for s in spells])
+        body = b'[' + b','.join(s.to_json() for s in spells) + b']'  # spells cache their own JSON
+        try:
+            response = self.http.post(f'/api/character/{character_id}/spellList/{list_id}', body)
+        except NotFound:  # the cached list may have been deleted since
+            self._invalidate(character_id, list_ids=True)
+            list_id = self._get_list_id(character_id, spell_list)
+            response = self.http.post(f'/api/character/{character_id}/spellList/{list_id}', body)
+        self._invalidate(character_id)
+        return response
 
     def create_character(self, name: str = "New Character", gender: str = None, race: str = None,
                          backstory: str = None):
@@ -112,6 +150,7 @@ class DicecloudClient:
 
     def delete_character(self, char_id: str):
         self.http.delete(f'/api/character/{char_id}')
+        self._invalidate(char_id, list_ids=True)
 
     def get_user_id(self, username: str):
         username = urllib.parse.quote_plus(username)
@@ -120,12 +159,14 @@ class DicecloudClient:
 
     def transfer_ownership(self, char_id: str, user_id: str):
         self.http.put(f'/api/character/{char_id}/owner', {'id': user_id})
+        self._invalidate(char_id, list_ids=True)
 
     def insert_feature(self, char_id, feature):
         return (self.insert_features(char_id, [feature]))[0]
 
     def insert_features(self, char_id: str, features: list):
         response = self.http.post(f'/api/character/{char_id}/feature', [f.to_dict() for f in features])
+        self._invalidate(char_id)
         return response
 
     def insert_proficiency(self, char_id, prof):
@@ -133,6 +174,7 @@ class DicecloudClient:
 
     def insert_proficiencies(self, char_id: str, profs: list):
         response = self.http.post(f'/api/character/{char_id}/prof', [p.to_dict() for p in profs])
+        self._invalidate(char_id)
         return response
 
     def insert_effect(self, char_id, effect):
@@ -140,11 +182,46 @@ class DicecloudClient:
 
     def insert_effects(self, char_id: str, effects: list):
         response = self.http.post(f'/api/character/{char_id}/effect', [e.to_dict() for e in effects])
+        self._invalidate(char_id)
         return response
 
+    def run_concurrently(self, calls):
+        """
+        Runs independent calls at the same time and waits for all of them to finish.
+        :param calls: (dict) A name for each call, mapped to a tuple of (func, *args).
+        :return: (dict) Each call's name mapped to its result.
+        :raises ConcurrentInsertFailure: if any of the calls raised.
+        """
+        # each call runs in a copy of this context, so its spans land in the caller's trace
+        futures = {name: get_executor().submit(contextvars.copy_context().run, func, *args)
+                   for name, (func, *args) in calls.items()}
+        results = {}
+        errors = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                log.warning(f"Concurrent call {name} failed: {e}")
+                errors[name] = e
+        if errors:
+            raise ConcurrentInsertFailure(errors, results)
+        return results
+
+    def insert_all(self, char_id: str, features: list = None, effects: list = None, proficiencies: list = None):
+        """Inserts features, effects, and proficiencies concurrently. Empty collections are skipped."""
+        calls = {}
+        if features:
+            calls['features'] = (self.insert_features, char_id, features)
+        if effects:
+            calls['effects'] = (self.insert_effects, char_id, effects)
+        if proficiencies:
+            calls['proficiencies'] = (self.insert_proficiencies, char_id, proficiencies)
+        return self.run_concurrently(calls)
+
     def insert_class(self, char_id, klass):
         return (self.insert_classes(char_id, [klass]))[0]
 
     def insert_classes(self, char_id: str, classes: list):
         response = self.http.post(f'/api/character/{char_id}/class', [c.to_dict() for c in classes])
+        self._invalidate(char_id)
         return response
@@ -17,6 +17,16 @@ class InsertFailure(DicecloudException):
         super().__init__(f"Failed to insert: {error}")
 
 
+class ConcurrentInsertFailure(InsertFailure):
+    """Raised when one or more concurrently run inserts fail.
+    ``errors`` maps each failed call to its exception, and ``results`` holds the calls that succeeded."""
+
+    def __init__(self, errors, results):
+        super(ConcurrentInsertFailure, self).__init__(', '.join(f"{name} ({e})" for name, e in errors.items()))
+        self.errors = errors
+        self.results = results
+
+
 class HTTPException(DicecloudException):
     """Generic HTTP exception (status code [400, 599])
     On a 400 we get some additional error message under err"""
@@ -45,3 +55,19 @@ class Timeout(HTTPException):
 
     def __init__(self, msg):
         super(Timeout, self).__init__(429, msg)
+
+
+class CircuitOpen(HTTPException):
+    """Dicecloud has been failing, so calls to it are rejected without being made"""
+
+    def __init__(self):
+        super(CircuitOpen, self).__init__(503, "Dicecloud is having trouble right now. Please try again in a few "
+                                               "minutes.")
+
+
+class DeadlineExceeded(HTTPException):
+    """The request's time budget for Dicecloud calls ran out"""
+
+    def __init__(self):
+        super(DeadlineExceeded, self).__init__(504, "Dicecloud is taking too long to respond right now. Please try "
+                                                    "again in a little while.")
@@ -1,19 +1,102 @@
+import http.cookiejar
 import json
 import logging
+import os
+import re
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from .errors import Forbidden, HTTPException, NotFound, Timeout
+from .breaker import get_breaker
+from .errors import CircuitOpen, DeadlineExceeded, Forbidden, HTTPException, NotFound, Timeout
+from .ratelimit import get_limiter
+from ..metrics import registry
+from ..tracing import span
 
 MAX_TRIES = 10
+RETRY_BUDGET = float(os.environ.get("DICECLOUD_RETRY_BUDGET", 30))  # seconds a request may spend throttled
+POOL_CONNECTIONS = int(os.environ.get("DICECLOUD_POOL_CONNECTIONS", 4))
+POOL_MAXSIZE = int(os.environ.get("DICECLOUD_POOL_MAXSIZE", 16))
+CONNECT_TIMEOUT = float(os.environ.get("DICECLOUD_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.environ.get("DICECLOUD_READ_TIMEOUT", 30))
 log = logging.getLogger(__name__)
 
+REQUEST_TIME = registry.histogram('dicecloud_request_duration_seconds', "Time taken by each Dicecloud API call.",
+                                  ('method', 'endpoint'))
+RESPONSES = registry.counter('dicecloud_responses_total', "Dicecloud API responses by status (or error).",
+                             ('endpoint', 'status'))
+RETRIES = registry.counter('dicecloud_retries_total', "Dicecloud API calls retried.", ('endpoint',))
+RATE_LIMITED = registry.counter('dicecloud_rate_limited_total', "Dicecloud API calls that returned 429.",
+                                ('endpoint',))
+REJECTED = registry.counter('dicecloud_circuit_rejected_total',
+                            "Dicecloud API calls failed fast by the circuit breaker.", ('endpoint',))
+ID_SEGMENT_RE = re.compile(r'/(character|spellList)/[^/?]+')
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Returns the process-wide keep-alive session shared by every DicecloudHTTP.
+    A new one is made after a fork so workers never share sockets with their parent. It shares connections only: it
+    never keeps cookies, which would otherwise be replayed on other users' requests."""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+def endpoint_template(endpoint):
+    """Strips IDs and the query string from an endpoint so metrics aren't labelled per character."""
+    return ID_SEGMENT_RE.sub(r'/\1/:id', endpoint.split('?')[0])
+
+
+def _reset_hint(resp):
+    """Returns the milliseconds until a 429'd rate limit window resets, if Dicecloud said."""
+    try:
+        hint = resp.json()
+    except ValueError:
+        return None
+    if isinstance(hint, dict):
+        hint = hint.get('timeToReset')
+    return hint if isinstance(hint, (int, float)) else None
+
 
 class DicecloudHTTP:
-    def __init__(self, api_base, api_key, debug=False):
+    def __init__(self, api_base, api_key, debug=False, timeout=None, deadline=None):
+        """
+        :param timeout: (connect, read) timeouts for each call, in seconds.
+        :param deadline: (float) A time.monotonic() time by which every call made through this client must finish.
+        """
         self.base = api_base
         self.key = api_key
         self.debug = debug
+        self.timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self.deadline = deadline
+        self.limiter = get_limiter(api_key)
+        self.breaker = get_breaker(api_base)
+
+    def _remaining(self):
+        return self.deadline - time.monotonic() if self.deadline is not None else None
+
+    def _attempt_timeout(self):
+        """This attempt's (connect, read) timeouts, cut short to whatever is left of the deadline."""
+        remaining = self._remaining()
+        if remaining is None:
+            return self.timeout
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return tuple(min(t, remaining) for t in self.timeout)
 
     def request(self, method, endpoint, body, headers=None, query=None):
         if headers is None:
@@ -24,6 +107,8 @@ class DicecloudHTTP:
         if body is not None:
             if isinstance(body, str):
                 headers["Content-Type"] = "text/plain"
+            elif isinstance(body, bytes):  # already encoded JSON
+                headers["Content-Type"] = "application/json"
             else:
                 body = json.dumps(body)
                 headers["Content-Type"] = "application/json"
@@ -31,17 +116,41 @@ class DicecloudHTTP:
         if self.debug:
             print(f"{method} {endpoint}: {body}")
         data = None
-        for _ in range(MAX_TRIES):
+        template = endpoint_template(endpoint)
+        deadline = time.monotonic() + RETRY_BUDGET
+        if self.deadline is not None:
+            deadline = min(deadline, self.deadline)
+        for attempt in range(MAX_TRIES):
+            if attempt:
+                RETRIES.inc(endpoint=template)
+            if not self.limiter.acquire(deadline):
+                if deadline == self.deadline:
+                    raise DeadlineExceeded()
+                raise Timeout("You have hit the rate limit. Please try again in a little while.")
+            timeout = self._attempt_timeout()  # waiting on the limiter may have used some of it
+            if not self.breaker.allow():
+                REJECTED.inc(endpoint=template)
+                raise CircuitOpen()
+            start = time.perf_counter()
             try:
-                resp = requests.request(method, f"{self.base}{endpoint}", data=body, headers=headers, params=query)
-                log.info(f"Dicecloud returned {resp.status_code} ({endpoint})")
+                with span('dicecloud', f"{method} {template}"):
+                    resp = get_session().request(method, f"{self.base}{endpoint}", data=body, headers=headers,
+                                                 params=query, timeout=timeout)
+                self.breaker.record(resp.status_code < 500)  # 4xx and 429 still mean Dicecloud is up
+                elapsed = time.perf_counter() - start
+                REQUEST_TIME.observe(elapsed, method=method, endpoint=template)
+                RESPONSES.inc(endpoint=template, status=resp.status_code)
+                log.info(f"Dicecloud returned {resp.status_code} ({endpoint}) in {elapsed * 1000:.0f}ms")
                 if resp.status_code == 200:
+                    self.limiter.success()
                     data = resp.json()
                     break
                 elif resp.status_code == 429:
-                    timeout = resp.json()
-                    log.warning(f"Dicecloud ratelimit hit ({endpoint}) - resets in {timeout}ms")
-                    raise Timeout("You have hit the rate limit.")
+                    RATE_LIMITED.inc(endpoint=template)
+                    reset_ms = _reset_hint(resp)
+                    delay = self.limiter.backoff(attempt, reset_ms / 1000 if reset_ms is not None else None)
+                    log.warning(f"Dicecloud ratelimit hit ({endpoint}) - resets in {reset_ms}ms, "
+                                f"backing off {delay:.2f}s")
                 elif 400 <= resp.status_code < 600:
                     if resp.status_code == 403:
                         raise Forbidden(resp.reason)
@@ -51,8 +160,20 @@ class DicecloudHTTP:
                         raise HTTPException(resp.status_code, resp.reason)
                 else:
                     log.warning(f"Unknown response from Dicecloud: {resp.status_code}")
+            except requests.Timeout:  # before ConnectionError, which ConnectTimeout also subclasses
+                self.breaker.record(False)
+                REQUEST_TIME.observe(time.perf_counter() - start, method=method, endpoint=template)
+                RESPONSES.inc(endpoint=template, status='timeout')
+                if self.deadline is not None and self._remaining() <= 0:
+                    raise DeadlineExceeded()
+                raise HTTPException(None, "Dicecloud took too long to respond")
             except requests.ConnectionError:
+                self.breaker.record(False)
+                RESPONSES.inc(endpoint=template, status='disconnected')
                 raise HTTPException(None, "Server disconnected")
+            except requests.RequestException:
+                self.breaker.record(False)
+                raise
         if not data:  # we did 10 loops and always got either 200 or 429 but we have no data, so we must have 429ed
             raise Timeout(f"Dicecloud failed to respond after {MAX_TRIES} tries. Please try again.")
 
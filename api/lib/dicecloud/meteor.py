@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+import time
+
+from MeteorClient import MeteorClient
+
+from .errors import DicecloudException, LoginFailure
+
+SOCKET_BASE = "wss://v1.dicecloud.com/websocket"
+METEOR_TIMEOUT = float(os.environ.get("DICECLOUD_METEOR_TIMEOUT", 10))  # seconds to wait for connect/login or a call
+
+log = logging.getLogger(__name__)
+
+_connections = {}  # (username, password) -> MeteorConnection
+_connections_pid = None
+_connections_lock = threading.Lock()
+
+
+class MeteorConnection:
+    """
+    A long-lived, logged-in DDP connection. The underlying client reconnects (and logs back in) on its own in the
+    background; callers block on a condition until the connection is ready instead of polling it. If logging back in
+    after a reconnect fails, the next caller retries the login.
+    """
+
+    def __init__(self, username, password, url=SOCKET_BASE, debug=False):
+        self.username = username
+        self.password = password
+        self.user_id = None
+        self.connected = False
+        self.logged_in = False
+        self._started = False
+        self._logging_in = False
+        self._login_error = None
+        self._ready = threading.Condition()
+        self._send_lock = threading.Lock()  # DDPClient's message IDs and socket writes are not thread-safe
+        self.client = MeteorClient(url, debug=debug)
+        self.client.on('connected', self._on_connected)
+        self.client.on('closed', self._on_closed)
+        self.client.on('logged_in', self._on_logged_in)
+        self.client.ddp_client.on('reconnected', self._on_reconnected)
+
+    def _on_connected(self):
+        with self._ready:
+            self.connected = True
+            self._login()
+            self._ready.notify_all()
+
+    def _on_reconnected(self):  # the socket is back; the client is logging back in on its own
+        with self._ready:
+            self.connected = True
+            self._ready.notify_all()
+
+    def _on_closed(self, code, reason):
+        log.warning(f"Dicecloud Meteor connection closed ({code}: {reason}); reconnecting in the background")
+        with self._ready:
+            self.connected = False
+            self.logged_in = False
+            self._ready.notify_all()
+
+    def _on_logged_in(self, data):  # also fires when the client logs back in after a reconnect
+        with self._ready:
+            self.connected = True
+            self.logged_in = True
+            self.user_id = data.get('id')
+            self._ready.notify_all()
+
+    def _on_login_result(self, error, data):
+        with self._ready:
+            self._logging_in = False
+            if error:
+                log.warning(f"Dicecloud Meteor login failed: {error}")
+                self._login_error = error
+            self._ready.notify_all()
+
+    def _login(self):
+        """Starts a login if one is not running. Must be called holding the condition."""
+        if self.logged_in or self._logging_in:
+            return
+        self._logging_in = True
+        self._login_error = None
+        with self._send_lock:
+            self.client.login(self.username, self.password, callback=self._on_login_result)
+
+    def wait_ready(self, timeout=METEOR_TIMEOUT):
+        """Blocks until the connection is logged in, connecting on first use.
+        :raises LoginFailure: if the login is rejected or does not finish within the timeout."""
+        with self._ready:
+            if self.logged_in:
+                return
+            start = time.monotonic()
+            if not self._started:
+                self._started = True
+                log.info(f"Connecting to Dicecloud Meteor as {self.username}")
+                self.client.connect()
+            elif self.connected:  # a previous login (or the client's own login after a reconnect) failed; try again
+                self._login()
+            self._ready.wait_for(lambda: self.logged_in or (self._login_error and not self._logging_in), timeout)
+            if not self.logged_in:
+                raise LoginFailure()
+            log.info(f"Logged in to Dicecloud as {self.user_id} in {time.monotonic() - start:.2f} seconds")
+
+    def call(self, method, params, timeout=METEOR_TIMEOUT):
+        """Calls a Meteor method and waits for its result."""
+        self.wait_ready(timeout)
+        done = threading.Event()
+        outcome = {}
+
+        def callback(error, result):
+            outcome['error'], outcome['result'] = error, result
+            done.set()
+
+        with self._send_lock:
+            self.client.call(method, params, callback=callback)
+        if not done.wait(timeout):
+            raise DicecloudException(f"Meteor call {method} timed out.")
+        if outcome['error']:
+            raise DicecloudException(f"Meteor call {method} failed: {outcome['error']}")
+        return outcome['result']
+
+
+def get_connection(username, password, debug=False):
+    """Returns the process-wide connection for the given credentials (made anew after a fork)."""
+    global _connections, _connections_pid
+    with _connections_lock:
+        if _connections_pid != os.getpid():
+            _connections = {}
+            _connections_pid = os.getpid()
+        conn = _connections.get((username, password))
+        if conn is None:
+            conn = _connections[username, password] = MeteorConnection(username, password, debug=debug)
+        return conn
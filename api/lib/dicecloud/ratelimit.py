@@ -0,0 +1,119 @@
+import os
+import random
+import threading
+import time
+
+from ..cache import LRUCache
+
+RATE = float(os.environ.get("DICECLOUD_RATE", 5))  # requests per second, per API key
+BURST = float(os.environ.get("DICECLOUD_BURST", 10))
+MIN_RATE = 1
+BACKOFF_BASE = 0.25  # seconds
+BACKOFF_CAP = 8
+LIMITERS_MAX = int(os.environ.get("DICECLOUD_LIMITERS_MAX", 4096))  # API keys remembered, least recently used first out
+
+
+class RateLimiter:
+    """
+    A token bucket that paces requests for one API key.
+    Rate limit responses cut the refill rate by a quarter and block the bucket until the upstream window reopens;
+    successful requests slowly restore the rate.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+        # stats
+        self.throttled_seconds = 0
+        self.waits = 0
+        self.rate_limited = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Takes a token and returns how many seconds the caller must wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            delay = max(self.blocked_until - now, -self.tokens / self.rate if self.tokens < 0 else 0)
+            if delay > 0:
+                self.waits += 1
+                self.throttled_seconds += delay
+            return delay
+
+    def acquire(self, deadline=None):
+        """Blocks until a request may be sent. Returns False without waiting if that would pass the deadline."""
+        delay = self.reserve()
+        if deadline is not None and time.monotonic() + delay > deadline:
+            with self.lock:
+                self.tokens += 1  # give the token back
+            return False
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def backoff(self, attempt, reset_after=None):
+        """Records a rate limit response and returns how long to back off before the next try, in seconds."""
+        delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+        if reset_after is not None:
+            delay = max(delay, reset_after)
+        with self.lock:
+            now = time.monotonic()
+            self.rate_limited += 1
+            self.rate = max(MIN_RATE, self.rate * 0.75)
+            self.blocked_until = max(self.blocked_until, now + delay)
+        return delay
+
+    def success(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def stats(self):
+        return {'rate': self.rate, 'throttled_seconds': self.throttled_seconds, 'waits': self.waits,
+                'rate_limited': self.rate_limited}
+
+
+class LimiterCache(LRUCache):
+    """The limiters of recently used API keys. Evicted limiters' counters are kept in ``retired``, so totals never go
+    backwards."""
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.retired = {'throttled_seconds': 0, 'waits': 0, 'rate_limited': 0}
+
+    def evicted(self, key, limiter):
+        for k in self.retired:
+            self.retired[k] += getattr(limiter, k)
+
+
+_limiters = LimiterCache(LIMITERS_MAX)
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(api_key):
+    with _limiters_lock:
+        limiter = _limiters.get(api_key)
+        if limiter is None:
+            limiter = RateLimiter()
+            _limiters.set(api_key, limiter)
+        return limiter
+
+
+def ratelimit_stats():
+    """Totals across every API key's limiter, including evicted ones."""
+    with _limiters_lock:
+        limiters = _limiters.values()
+        totals = {'keys': len(limiters), **_limiters.retired}
+    for limiter in limiters:
+        for k in ('throttled_seconds', 'waits', 'rate_limited'):
+            totals[k] += getattr(limiter, k)
+    return totals
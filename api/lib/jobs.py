@@ -0,0 +1,164 @@
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .tracing import start_trace
+
+JOB_DB = os.environ.get("JOB_DB", "./jobs.sqlite3")
+JOB_TTL = 60 * 60  # finished jobs are kept this long, in seconds
+JOB_STALE_AFTER = float(os.environ.get("JOB_STALE_AFTER", 15 * 60))  # unfinished jobs older than this have failed
+LOST_JOB_ERROR = "The server lost track of your character before it was finished. Check Dicecloud before trying again."
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted to a queue that already has its maximum number of pending jobs."""
+
+    def __init__(self):
+        super().__init__("The server is busy right now. Please try again in a minute.")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, but belongs to someone else
+        return True
+    return True
+
+
+def _lost(pid, created, now):
+    """Whether an unfinished job can no longer finish."""
+    return created < now - JOB_STALE_AFTER or pid is None or not _pid_alive(pid)
+
+
+class JobQueue:
+    """
+    Runs jobs on a bounded in-process thread pool. Job state lives in a local SQLite database, so any gunicorn worker
+    can answer status polls for a job that another worker is running.
+
+    A job is called with a ``progress`` keyword argument, which it can call with the name of its current stage. Each
+    job runs under its own trace; its spans are stored with the job as a Server-Timing value.
+
+    Each job records the pid of the process running it. Unfinished jobs whose process has died (or that are older than
+    JOB_STALE_AFTER, in case the pid was reused) are lost: they are marked failed when a queue starts, when a job is
+    submitted, and when stats are read (which the metrics collector does every few seconds). Status polls only read,
+    and report a lost job as failed before it has been marked.
+    """
+
+    def __init__(self, name, workers=4, max_pending=32, db_path=JOB_DB):
+        self.name = name
+        self.max_pending = max_pending
+        self.db_path = db_path
+        self.pending = 0  # in this process
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-job")
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, queue TEXT, status TEXT, stage TEXT, "
+                       "result TEXT, error TEXT, created REAL, started REAL, finished REAL, timing TEXT, pid INTEGER)")
+            for column in ('timing TEXT', 'pid INTEGER'):  # databases from before these were recorded
+                try:
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    pass
+            self._reap(db)
+
+    @contextlib.contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with db:  # commits on success
+                yield db
+        finally:
+            db.close()
+
+    def _update(self, job_id, **fields):
+        with self._db() as db:
+            db.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                       (*fields.values(), job_id))
+
+    def submit(self, func, *args):
+        """Queues func(*args) and returns the job's ID.
+        :raises QueueFull: if this process already has max_pending jobs waiting or running."""
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise QueueFull()
+            self.pending += 1
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        try:
+            with self._db() as db:
+                db.execute("DELETE FROM jobs WHERE finished < ?", (now - JOB_TTL,))
+                self._reap(db)
+                db.execute("INSERT INTO jobs (id, queue, status, stage, created, pid) "
+                           "VALUES (?, ?, 'queued', 'queued', ?, ?)", (job_id, self.name, now, os.getpid()))
+            self._executor.submit(self._run, job_id, func, args)
+        except Exception:  # e.g. the database is locked; the job never got a slot
+            with self._lock:
+                self.pending -= 1
+            raise
+        return job_id
+
+    def _reap(self, db):
+        """Marks unfinished jobs whose process is gone (or that are too old to still be running) as failed."""
+        now = time.time()
+        active = db.execute("SELECT id, pid, created FROM jobs WHERE queue = ? AND status IN ('queued', 'running')",
+                            (self.name,)).fetchall()
+        lost = [job_id for job_id, pid, created in active if _lost(pid, created, now)]
+        if lost:
+            log.warning(f"Marking {len(lost)} lost {self.name} jobs as failed")
+            db.executemany("UPDATE jobs SET status = 'failed', error = ?, finished = ? "
+                           "WHERE id = ? AND status IN ('queued', 'running')",
+                           [(LOST_JOB_ERROR, now, job_id) for job_id in lost])
+
+    def _run(self, job_id, func, args):
+        self._update(job_id, status='running', started=time.time())
+        trace = start_trace(self.name)
+        try:
+            result = func(*args, progress=lambda stage: self._update(job_id, stage=stage))
+        except Exception as e:
+            log.warning(f"{self.name} job {job_id} failed: {e}")
+            timing = trace.finish(job=job_id, status='failed').server_timing()
+            self._update(job_id, status='failed', error=str(e), finished=time.time(), timing=timing)
+        else:
+            timing = trace.finish(job=job_id, status='done').server_timing()
+            self._update(job_id, status='done', stage='done', result=result, finished=time.time(), timing=timing)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def get(self, job_id):
+        """Returns the job's state as a dict, or None if there is no such job."""
+        with self._db() as db:
+            db.row_factory = sqlite3.Row
+            row = db.execute("SELECT * FROM jobs WHERE id = ? AND queue = ?", (job_id, self.name)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        if job['status'] in ('queued', 'running') and _lost(job['pid'], job['created'], time.time()):
+            job.update(status='failed', error=LOST_JOB_ERROR)  # marked the next time the queue is reaped
+        return job
+
+    def stats(self):
+        """Queue depth and job latency across every process sharing the database."""
+        with self._db() as db:
+            self._reap(db)
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM jobs WHERE queue = ? GROUP BY status",
+                                     (self.name,)).fetchall())
+            wait, run, total = db.execute(
+                "SELECT AVG(started - created), AVG(finished - started), AVG(finished - created) FROM jobs "
+                "WHERE queue = ? AND finished IS NOT NULL AND error IS NOT ?",  # lost jobs never really finished
+                (self.name, LOST_JOB_ERROR)).fetchone()
+        return {
+            'queued': counts.get('queued', 0), 'running': counts.get('running', 0), 'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0), 'pending_in_process': self.pending,
+            'avg_wait_seconds': wait, 'avg_run_seconds': run, 'avg_latency_seconds': total
+        }
@@ -0,0 +1,20 @@
+import os
+import resource
+
+
+def memory_usage():
+    """
+    Returns this process's memory use in kB. On Linux this includes how much of its resident memory is still shared
+    with other processes (e.g. copy-on-write pages inherited from a preloading gunicorn master) versus private.
+    """
+    try:
+        with open(f"/proc/{os.getpid()}/smaps_rollup") as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+    except OSError:
+        return {'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+    def kb(name):
+        return int(fields.get(name, '0 kB').split()[0])
+
+    return {'rss': kb('Rss'), 'pss': kb('Pss'), 'shared': kb('Shared_Clean') + kb('Shared_Dirty'),
+            'private': kb('Private_Clean') + kb('Private_Dirty')}
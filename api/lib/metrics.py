@@ -0,0 +1,271 @@
+"""
+Prometheus-style metrics, safe to use from several gunicorn workers.
+
+Each process keeps its own metric values in memory (updating one takes a single short lock). When METRICS_DIR is set,
+each process also writes its values to a file there every few seconds. The process that serves /metrics merges every
+process's file: counters and histograms are summed, and each gauge is merged by its ``mode`` ('sum' or 'max').
+
+Gauges from processes that have exited are dropped. When a worker exits, the gunicorn master folds its counters and
+histograms into a single file of retired totals (``retire``) and deletes the worker's file.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+METRICS_DIR = os.environ.get("METRICS_DIR")
+FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+RETIRED_FILE = "retired.json"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, registry, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self.values = {}  # tuple of label values -> value
+        self.lock = registry.lock
+        registry.metrics[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels.get(l, '')) for l in self.labels)
+
+    def dump(self):
+        with self.lock:
+            return {'type': self.type, 'help': self.help, 'labels': self.labels,
+                    'values': [[list(k), v] for k, v in self.values.items()]}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """For counters whose value is tracked elsewhere (e.g. cache hits) and copied in by a collector."""
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, registry, name, help_, labels=(), mode='sum'):
+        super().__init__(registry, name, help_, labels)
+        self.mode = mode
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def dump(self):
+        return dict(super().dump(), mode=self.mode)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, help_, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:  # one count per bucket, then +Inf, sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def dump(self):
+        return dict(super().dump(), buckets=self.buckets)
+
+
+class Registry:
+    def __init__(self, directory=METRICS_DIR):
+        self.directory = directory
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+        self._flusher_pid = None
+        self._file = None
+        self._flush_lock = threading.Lock()  # the flusher thread and scrapes both flush, through the same temp file
+
+    def counter(self, name, help_, labels=()):
+        return Counter(self, name, help_, labels)
+
+    def gauge(self, name, help_, labels=(), mode='sum'):
+        return Gauge(self, name, help_, labels, mode)
+
+    def histogram(self, name, help_, labels=(), buckets=DEFAULT_BUCKETS):
+        return Histogram(self, name, help_, labels, buckets)
+
+    def collector(self, func):
+        """Registers a function that updates metrics from stats kept elsewhere, run before each flush or scrape."""
+        self.collectors.append(func)
+        return func
+
+    def collect(self):
+        for func in self.collectors:
+            try:
+                func()
+            except Exception:  # a broken collector shouldn't take /metrics down with it
+                pass
+        return {name: metric.dump() for name, metric in self.metrics.items()}
+
+    # ==== multiprocess ====
+    def start(self):
+        """Starts this process's flusher thread if there is a metrics directory and it isn't running yet."""
+        if self.directory is None or self._flusher_pid == os.getpid():
+            return
+        with self.lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = os.path.join(self.directory, f"{os.getpid()}-{int(time.time() * 1000)}.json")
+            thread = threading.Thread(target=self._flush_forever, name='metrics-flusher', daemon=True)
+            thread.start()
+        atexit.register(self.flush)
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        if self._file is None:
+            return
+        tmp = f"{self._file}.tmp"
+        with self._flush_lock:
+            with open(tmp, 'w') as f:
+                json.dump(self.collect(), f)
+            os.replace(tmp, self._file)
+
+    def _load(self, filename):
+        try:
+            with open(os.path.join(self.directory, filename)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _merged(self):
+        if self.directory is None:
+            return self.collect()
+        self.flush()
+        merged = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            dumped = self._load(filename)
+            if dumped is not None:
+                pid = _file_pid(filename)
+                _merge(merged, dumped, gauges=pid is not None and _pid_alive(pid))
+        return _listed(merged)
+
+    def retire(self, pid=None):
+        """Folds the counters and histograms of an exited process (by default, of every process that is no longer
+        running) into the retired totals, and deletes its files. Only the gunicorn master should call this."""
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        filenames = []
+        for filename in os.listdir(self.directory):
+            file_pid = _file_pid(filename) if filename.endswith('.json') else None
+            if file_pid is not None and (file_pid == pid if pid is not None else not _pid_alive(file_pid)):
+                filenames.append(filename)
+        if not filenames:
+            return
+        retired = {}
+        _merge(retired, self._load(RETIRED_FILE) or {}, gauges=False)
+        for filename in filenames:
+            _merge(retired, self._load(filename) or {}, gauges=False)
+        path = os.path.join(self.directory, RETIRED_FILE)
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(_listed(retired), f)
+        os.replace(f"{path}.tmp", path)
+        for filename in filenames:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+    # ==== exposition ====
+    def exposition(self):
+        """Returns every metric, merged across processes, in the Prometheus text format."""
+        lines = []
+        for name, metric in sorted(self._merged().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in metric['values']:
+                labels = list(zip(metric['labels'], key))
+                if metric['type'] != 'histogram':
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(metric['buckets']) + ['+Inf'], value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+def _file_pid(filename):
+    """The pid a metrics file was written by, or None for the retired totals."""
+    pid, sep, _ = filename.partition('-')
+    return int(pid) if sep and pid.isdigit() else None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge(merged, dumped, gauges=True):
+    """Adds one process's dumped metrics into ``merged``, whose values are dicts keyed by label tuples."""
+    for name, metric in dumped.items():
+        if metric['type'] == 'gauge' and not gauges:
+            continue
+        into = merged.setdefault(name, dict(metric, values={}))
+        for key, value in metric['values']:
+            key = tuple(key)
+            if key not in into['values']:
+                into['values'][key] = value
+            elif metric['type'] == 'histogram':
+                into['values'][key] = [a + b for a, b in zip(into['values'][key], value)]
+            elif metric['type'] == 'gauge' and metric.get('mode') == 'max':
+                into['values'][key] = max(into['values'][key], value)
+            else:
+                into['values'][key] += value
+
+
+def _listed(merged):
+    return {name: dict(metric, values=list(metric['values'].items())) for name, metric in merged.items()}
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+registry = Registry()
@@ -0,0 +1,101 @@
+"""
+Operator-only profiling of single live requests. Nothing here is installed unless PROFILE_SECRET is set; when it is,
+a request to a profiled endpoint that sends the secret in the X-Profile header runs under cProfile (and, with
+``X-Profile-Memory: 1``, tracemalloc), and its profile is saved to PROFILE_DIR under the ID returned in the
+X-Profile-Id response header.
+"""
+import cProfile
+import functools
+import hmac
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+import uuid
+
+from flask import abort, g, make_response, request
+
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "./profiles")
+PROFILE_TOP = 50  # functions listed in the text report
+PROFILE_ALLOC_TOP = 25  # allocation sites listed in the text report
+
+log = logging.getLogger(__name__)
+
+
+def authorized():
+    # compared as bytes: compare_digest raises TypeError on str with non-ASCII characters
+    return hmac.compare_digest(request.headers.get('X-Profile', '').encode(), PROFILE_SECRET.encode())
+
+
+def _report(profile_id, profiler, elapsed, alloc_diff):
+    out = io.StringIO()
+    out.write(f"{request.method} {request.full_path} took {elapsed * 1000:.1f}ms\n\n")
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    if alloc_diff is not None:
+        out.write(f"\nTop {PROFILE_ALLOC_TOP} allocation sites by growth:\n")
+        for stat in alloc_diff[:PROFILE_ALLOC_TOP]:
+            out.write(f"{stat}\n")
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f"{profile_id}.prof"))  # for pstats/snakeviz
+    with open(os.path.join(PROFILE_DIR, f"{profile_id}.txt"), 'w') as f:
+        f.write(out.getvalue())
+
+
+def profiled(view):
+    """Wraps a view so that authorized requests run under the profiler."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not authorized():
+            return view(*args, **kwargs)
+
+        trace_memory = request.headers.get('X-Profile-Memory') == '1'
+        started_tracemalloc = trace_memory and not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot() if trace_memory else None
+
+        g.profiling = True
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            response = view(*args, **kwargs)
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            alloc_diff = None
+            if trace_memory:
+                alloc_diff = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+                if started_tracemalloc:
+                    tracemalloc.stop()
+            profile_id = uuid.uuid4().hex
+            _report(profile_id, profiler, elapsed, alloc_diff)
+            log.info(f"profiled {request.path} as {profile_id} ({elapsed * 1000:.1f}ms)")
+        response = make_response(response)
+        response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    return wrapper
+
+
+def install(app, endpoints):
+    """Wraps the given endpoints with the profiler, and adds a route to fetch saved reports. Does nothing unless
+    PROFILE_SECRET is set, so unprofiled deployments keep their views untouched."""
+    if not PROFILE_SECRET:
+        return
+    for endpoint in endpoints:
+        app.view_functions[endpoint] = profiled(app.view_functions[endpoint])
+
+    @app.route('/_profile/<profile_id>', methods=["GET"])
+    def profile_report(profile_id):
+        if not authorized() or not profile_id.isalnum():
+            abort(404)
+        try:
+            with open(os.path.join(PROFILE_DIR, f"{profile_id}.txt")) as f:
+                return f.read(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+        except FileNotFoundError:
+            abort(404)
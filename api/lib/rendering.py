@@ -1,77 +1,208 @@
+import hashlib
+import json
 import logging
+import os
 import re
+import types
+
+from .cache import LRUCache
 
 ABILITY_MAP = {'str': 'Strength', 'dex': 'Dexterity', 'con': 'Constitution',
                'int': 'Intelligence', 'wis': 'Wisdom', 'cha': 'Charisma'}
 
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", 8192))
+
 log = logging.getLogger(__name__)
 
 
+class RenderCache(LRUCache):
+    """An LRU of rendered text, keyed by a content hash of the entry and the md_breaks flag."""
+
+    @staticmethod
+    def key(text, md_breaks):
+        raw = json.dumps(text, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.blake2b(raw.encode(), digest_size=16).digest(), md_breaks
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+
 def render(text, md_breaks=False):
-    """Parses a list or string from... data.
+    """Parses a list or string from... data. Results are memoized in ``render_cache``.
     :returns str - The final text."""
-    if not isinstance(text, list):
-        return parse_data_formatting(str(text))
+    if render_cache.maxsize <= 0:
+        return _render(text, md_breaks)
+    try:
+        key = render_cache.key(text, md_breaks)
+    except RecursionError:  # too deep to hash, but the render engine itself has no depth limit
+        return _render(text, md_breaks)
+    out = render_cache.get(key)
+    if out is None:
+        out = _render(text, md_breaks)
+        render_cache.set(key, out)
+    return out
 
-    out = []
-    join_str = '\n' if not md_breaks else '  \n'
-
-    for entry in text:
-        if not isinstance(entry, dict):
-            out.append(str(entry))
-        elif isinstance(entry, dict):
-            if not 'type' in entry and 'title' in entry:
-                out.append(f"**{entry['title']}**: {render(entry['text'])}")
-            elif not 'type' in entry and 'istable' in entry:  # only for races
-                temp = f"**{entry['caption']}**\n" if 'caption' in entry else ''
-                temp += ' - '.join(f"**{cl}**" for cl in entry['thead']) + '\n'
-                for row in entry['tbody']:
-                    temp += ' - '.join(f"{col}" for col in row) + '\n'
-                out.append(temp.strip())
-            elif not 'type' in entry:
-                out.append((f"**{entry['name']}**: " if 'name' in entry else '') +
-                           render(entry['entries']))
-            elif entry['type'] == 'entries':
-                out.append((f"**{entry['name']}**: " if 'name' in entry else '') + render(
-                    entry['entries']))  # oh gods here we goooooooo
-            elif entry['type'] == 'item':
-                out.append((f"**{entry['name']}**: " if 'name' in entry else '') + render(
-                    entry['entry']))  # oh gods here we goooooooo
-            elif entry['type'] == 'options':
-                pass  # parsed separately in classfeat
-            elif entry['type'] == 'list':
-                out.append('\n'.join(f"- {render([t])}" for t in entry['items']))
-            elif entry['type'] == 'table':
-                temp = f"**{entry['caption']}**\n" if 'caption' in entry else ''
-                temp += ' - '.join(f"**{cl}**" for cl in entry['colLabels']) + '\n'
-                for row in entry['rows']:
-                    temp += ' - '.join(f"{col}" for col in row) + '\n'
-                out.append(temp.strip())
-            elif entry['type'] == 'invocation':
-                pass  # this is only found in options
-            elif entry['type'] == 'abilityAttackMod':
-                out.append(f"`{entry['name']} Attack Bonus = "
-                           f"{' or '.join(ABILITY_MAP.get(a) for a in entry['attributes'])}"
-                           f" modifier + Proficiency Bonus`")
-            elif entry['type'] == 'abilityDc':
-                out.append(f"`{entry['name']} Save DC = 8 + "
-                           f"{' or '.join(ABILITY_MAP.get(a) for a in entry['attributes'])}"
-                           f" modifier + Proficiency Bonus`")
-            elif entry['type'] == 'bonus':
-                out.append("{:+}".format(entry['value']))
-            elif entry['type'] == 'dice':
-                if 'toRoll' in entry:
-                    out.append(' + '.join(f"{d['number']}d{d['faces']}" for d in entry['toRoll']))
-                else:
-                    out.append(f"{entry['number']}d{entry['faces']}")
-            elif entry['type'] == 'bonusSpeed':
-                out.append(f"{entry['value']} feet")
+
+def _render(text, md_breaks=False):
+    return renderer.render(text, md_breaks)
+
+
+class Renderer:
+    """
+    Renders 5etools-style entries with a table of handlers keyed by entry type.
+
+    A handler takes an entry and returns its text, or None to skip it. To render nested entries, a handler can be a
+    generator: ``text = yield entry['entries']`` hands the nested entries to the engine and resumes with their rendered
+    text, and the generator's return value is the entry's text. The engine drives these generators with an explicit
+    stack, so nesting depth is not limited by the recursion limit.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def handler(self, *types):
+        """Registers the decorated function as the handler for the given entry types."""
+
+        def decorator(func):
+            for type_ in types:
+                self.handlers[type_] = func
+            return func
+
+        return decorator
+
+    @staticmethod
+    def entry_type(entry):
+        if 'type' in entry:
+            return entry['type']
+        if 'title' in entry:
+            return '_titled'
+        if 'istable' in entry:  # only for races
+            return '_table'
+        return '_untyped'
+
+    def render(self, text, md_breaks=False):
+        """Parses a list or string from... data.
+        :returns str - The final text."""
+        if not isinstance(text, list):
+            return parse_data_formatting(str(text))
+
+        stack = [self._render_list(text, '\n' if not md_breaks else '  \n')]
+        value = None
+        while True:
+            try:
+                request = stack[-1].send(value)
+            except StopIteration as e:
+                stack.pop()
+                if not stack:
+                    return e.value
+                value = e.value
+                continue
+            if isinstance(request, types.GeneratorType):  # a handler that renders nested entries
+                stack.append(request)
+                value = None
+            elif isinstance(request, list):
+                stack.append(self._render_list(request, '\n'))
+                value = None
             else:
+                value = parse_data_formatting(str(request))
+
+    def _render_list(self, entries, join_str):
+        out = []
+        for entry in entries:
+            if not isinstance(entry, dict):
+                out.append(str(entry))
+                continue
+            handler = self.handlers.get(self.entry_type(entry))
+            if handler is None:
                 log.warning(f"Missing entry type parse: {entry}")
-        else:
-            log.warning(f"Unknown entry: {entry}")
+                continue
+            text = handler(entry)
+            if isinstance(text, types.GeneratorType):
+                text = yield text
+            if text is not None:
+                out.append(text)
+        return parse_data_formatting(join_str.join(out))
+
+
+renderer = Renderer()
+
+
+def _table(entry, labels, rows):
+    lines = [f"**{entry['caption']}**"] if 'caption' in entry else []
+    lines.append(' - '.join(f"**{cl}**" for cl in labels))
+    lines.extend(' - '.join(f"{col}" for col in row) for row in rows)
+    return '\n'.join(lines).strip()
+
+
+@renderer.handler('_titled')
+def _render_titled(entry):
+    return f"**{entry['title']}**: {(yield entry['text'])}"
+
+
+@renderer.handler('_table')
+def _render_race_table(entry):
+    return _table(entry, entry['thead'], entry['tbody'])
+
 
-    return parse_data_formatting(join_str.join(out))
+@renderer.handler('_untyped', 'entries')
+def _render_entries(entry):
+    prefix = f"**{entry['name']}**: " if 'name' in entry else ''
+    return prefix + (yield entry['entries'])  # oh gods here we goooooooo
+
+
+@renderer.handler('item')
+def _render_item(entry):
+    prefix = f"**{entry['name']}**: " if 'name' in entry else ''
+    return prefix + (yield entry['entry'])
+
+
+@renderer.handler('options', 'invocation')
+def _render_skipped(entry):
+    return None  # options are parsed separately in classfeat, and invocations are only found in options
+
+
+@renderer.handler('list')
+def _render_bullets(entry):
+    items = []
+    for t in entry['items']:
+        items.append(f"- {(yield [t])}")
+    return '\n'.join(items)
+
+
+@renderer.handler('table')
+def _render_table(entry):
+    return _table(entry, entry['colLabels'], entry['rows'])
+
+
+@renderer.handler('abilityAttackMod')
+def _render_attack_mod(entry):
+    return (f"`{entry['name']} Attack Bonus = "
+            f"{' or '.join(ABILITY_MAP.get(a) for a in entry['attributes'])}"
+            f" modifier + Proficiency Bonus`")
+
+
+@renderer.handler('abilityDc')
+def _render_dc(entry):
+    return (f"`{entry['name']} Save DC = 8 + "
+            f"{' or '.join(ABILITY_MAP.get(a) for a in entry['attributes'])}"
+            f" modifier + Proficiency Bonus`")
+
+
+@renderer.handler('bonus')
+def _render_bonus(entry):
+    return "{:+}".format(entry['value'])
+
+
+@renderer.handler('dice')
+def _render_dice(entry):
+    if 'toRoll' in entry:
+        return ' + '.join(f"{d['number']}d{d['faces']}" for d in entry['toRoll'])
+    return f"{entry['number']}d{entry['faces']}"
+
+
+@renderer.handler('bonusSpeed')
+def _render_bonus_speed(entry):
+    return f"{entry['value']} feet"
 
 
 FORMATTING = {'bold': '**', 'italic': '*', 'b': '**', 'i': '*'}
@@ -84,20 +215,84 @@ PARSING = {
 }
 
 
+_TAG = re.compile(r'{@(\w+) (.+?)}')
+_TOKEN = re.compile(r'{@(\w+) |}')
+
+
+def _format_tag(tag, content):
+    if tag in PARSING:
+        return PARSING[tag](content)
+    if tag not in FORMATTING:
+        log.warning(f"Unknown tag: {tag}")
+    f = FORMATTING.get(tag, '')
+    return f"{f}{content}{f}"
+
+
+class _NestedTag(Exception):
+    pass
+
+
+def _sub_tag(match):
+    if '{@' in match.group(2):
+        raise _NestedTag()
+    return _format_tag(match.group(1), match.group(2))
+
+
 def parse_data_formatting(text):
-    """Parses a {@format } string."""
-    exp = re.compile(r'{@(\w+) (.+?)}')
+    """Parses a {@format } string.
+    Text without nested tags is handled by a single regex substitution; anything else goes to the stack parser."""
+    if '{@' not in text:
+        return text
+    try:
+        out = _TAG.sub(_sub_tag, text)
+    except _NestedTag:
+        return _parse_nested(text)
+    if '{@' in out:
+        return _parse_nested(text)
+    return out
+
 
-    def sub(match):
-        if match.group(1) in PARSING:
-            f = PARSING.get(match.group(1), lambda e: e)
-            return f(match.group(2))
+def _unwind(stack, out):
+    """Turns every open tag back into literal text (tags can't span lines or run off the end of the text)."""
+    while stack:
+        _, opener, _, parent = stack.pop()
+        parent.append(opener)
+        parent.extend(out)
+        out = parent
+    return out
+
+
+def _parse_nested(text):
+    """Single-pass, stack-based parse that resolves nested tags from the inside out."""
+    stack = []  # (tag, opener text, content start, parent output) for each open tag
+    out = []
+    pos = 0
+    for match in _TOKEN.finditer(text):
+        start = match.start()
+        if start > pos:
+            chunk = text[pos:start]
+            if stack and '\n' in chunk:
+                line_end = chunk.index('\n')
+                out.append(chunk[:line_end])
+                out = _unwind(stack, out)
+                chunk = chunk[line_end:]
+            out.append(chunk)
+        pos = match.end()
+        if match.group(1) is not None:  # {@tag
+            stack.append((match.group(1), match.group(0), pos, out))
+            out = []
+        elif stack and start > stack[-1][2]:  # } closing a tag with non-empty content
+            tag, _, _, parent = stack.pop()
+            parent.append(_format_tag(tag, ''.join(out)))
+            out = parent
         else:
-            f = FORMATTING.get(match.group(1), '')
-            if not match.group(1) in FORMATTING:
-                log.warning(f"Unknown tag: {match.group(1)}")
-            return f"{f}{match.group(2)}{f}"
-
-    while exp.search(text):
-        text = exp.sub(sub, text)
-    return text
+            out.append('}')
+    if pos < len(text):
+        chunk = text[pos:]
+        if stack and '\n' in chunk:
+            line_end = chunk.index('\n')
+            out.append(chunk[:line_end])
+            out = _unwind(stack, out)
+            chunk = chunk[line_end:]
+        out.append(chunk)
+    return ''.join(_unwind(stack, out))
@@ -0,0 +1,82 @@
+import bisect
+import collections
+
+from lib.compendium import SCHOOLS
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SpellIndex:
+    """
+    Indexes for searching the compendium's spells, built once.
+    Names are searched by prefix (queries shorter than 3 characters) or by substring through a trigram index; the other
+    filters are inverted indexes from a value to the set of spell indices that have it.
+    """
+
+    def __init__(self, spells):
+        self.spells = spells
+        self.names = [spell.name.lower() for spell in spells]
+        self.sorted_names = sorted((name, i) for i, name in enumerate(self.names))
+        self.trigrams = collections.defaultdict(set)
+        self.by_class = collections.defaultdict(set)
+        self.by_level = collections.defaultdict(set)
+        self.by_school = collections.defaultdict(set)
+        self.by_ritual = {True: set(), False: set()}
+        self.by_concentration = {True: set(), False: set()}
+
+        for i, spell in enumerate(spells):
+            for trigram in _trigrams(self.names[i]):
+                self.trigrams[trigram].add(i)
+            for klass in spell.classes:
+                self.by_class[klass.lower()].add(i)
+            self.by_level[int(spell.level)].add(i)
+            self.by_school[spell.get_school().lower()].add(i)
+            self.by_ritual[bool(spell.ritual)].add(i)
+            self.by_concentration[bool(spell.concentration)].add(i)
+
+    def _name_matches(self, query):
+        if len(query) < 3:
+            start = bisect.bisect_left(self.sorted_names, (query,))
+            out = set()
+            for name, i in self.sorted_names[start:]:
+                if not name.startswith(query):
+                    break
+                out.add(i)
+            return out
+        candidates = None
+        for trigram in _trigrams(query):
+            postings = self.trigrams.get(trigram, set())
+            candidates = postings if candidates is None else candidates & postings
+            if not candidates:
+                return set()
+        return {i for i in candidates if query in self.names[i]}
+
+    def search(self, query=None, klass=None, level=None, school=None, ritual=None, concentration=None):
+        """
+        Returns the indices of every matching spell, in compendium order.
+        :param query: (str) Matches spell names containing this (or starting with it, if shorter than 3 characters).
+        :param klass: (str) Matches spells on the list of any class whose name contains this.
+        :param school: (str) A school name or its one-letter code.
+        """
+        filters = []
+        if query:
+            filters.append(self._name_matches(query.lower()))
+        if klass:
+            klass = klass.lower()
+            filters.append(set().union(*(v for k, v in self.by_class.items() if klass in k)))
+        if level is not None:
+            filters.append(self.by_level.get(level, set()))
+        if school:
+            school = SCHOOLS.get(school.upper(), school).lower()
+            filters.append(self.by_school.get(school, set()))
+        if ritual is not None:
+            filters.append(self.by_ritual[ritual])
+        if concentration is not None:
+            filters.append(self.by_concentration[concentration])
+
+        if not filters:
+            return list(range(len(self.spells)))
+        filters.sort(key=len)
+        return sorted(set.intersection(*filters))
@@ -0,0 +1,97 @@
+"""
+Lightweight timing spans. Code wraps a phase in ``with span('name'):``; if a trace is active in the current context,
+the span's duration is recorded in it, otherwise the span does nothing.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+SLOW_REQUEST_THRESHOLD = float(os.environ.get("SLOW_REQUEST_THRESHOLD", 5))  # seconds
+
+log = logging.getLogger(__name__)
+slow_log = logging.getLogger('slow_requests')
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []  # (name, description, duration)
+        self._lock = threading.Lock()
+
+    def add(self, name, duration, description=None):
+        with self._lock:
+            self.spans.append((name, description, duration))
+
+    def finish(self, **context):
+        """Stops the trace (ending it in the current context), and logs it to the slow request log if it took longer
+        than the threshold."""
+        self.duration = time.perf_counter() - self.start
+        if _current.get() is self:
+            _current.set(None)
+        if self.duration >= SLOW_REQUEST_THRESHOLD:
+            slow_log.warning(json.dumps({
+                'trace': self.name, 'duration_ms': round(self.duration * 1000, 1), **context,
+                'spans': [{'name': n, 'desc': d, 'duration_ms': round(t * 1000, 1)} for n, d, t in self.spans]
+            }))
+        return self
+
+    def server_timing(self):
+        """The trace's spans (and total, if finished) as a Server-Timing header value."""
+        entries = []
+        for name, description, duration in self.spans:
+            desc = f';desc="{description}"' if description else ''
+            entries.append(f"{name}{desc};dur={duration * 1000:.1f}")
+        if self.duration is not None:
+            entries.append(f"total;dur={self.duration * 1000:.1f}")
+        return ', '.join(entries)
+
+
+def start_trace(name):
+    """Starts a trace in the current context and returns it."""
+    trace = Trace(name)
+    _current.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current.get()
+
+
+class Phases:
+    """Times back-to-back phases without nesting code in spans: each start() ends the previous phase."""
+
+    def __init__(self):
+        self.trace = _current.get()
+        self.name = None
+        self.started = None
+
+    def start(self, name):
+        self.end()
+        self.name = name
+        self.started = time.perf_counter()
+
+    def end(self):
+        if self.trace is not None and self.name is not None:
+            self.trace.add(self.name, time.perf_counter() - self.started)
+        self.name = None
+
+
+@contextlib.contextmanager
+def span(name, description=None):
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start, description)
@@ -0,0 +1,120 @@
+"""
+Fires a mix of /autochar and /spellbook traffic at a running web.py (pointed at loadtest.fakecloud) and reports
+throughput, latency percentiles, and the mix of errors. Run from the api directory:
+
+    python -m loadtest.driver [--target http://127.0.0.1:8000] [--requests 200] [--concurrency 10]
+                              [--spellbook-ratio 0.5] [--keys 3]
+
+An autochar request is timed from submission until its job finishes.
+"""
+import argparse
+import collections
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+JOB_TIMEOUT = 120
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Driver:
+    def __init__(self, target, keys, spellbook_ratio):
+        self.target = target.rstrip('/')
+        self.keys = [f"loadtest-key-{i}" for i in range(keys)]
+        self.spellbook_ratio = spellbook_ratio
+        self.session = requests.Session()
+        self.options = self.session.get(f"{self.target}/autochar_options").json()
+        self.num_spells = len(self.session.get(f"{self.target}/spell_options").json())
+        self.characters = []  # URLs of characters made so far, for spellbook requests
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def autochar(self, key):
+        klass = random.randrange(len(self.options['classes']))
+        form = {'apiKey': key, 'charName': "Load Test", 'level': random.randint(1, 20),
+                'race': random.randrange(len(self.options['races'])), 'class': klass,
+                'subclass': random.randrange(max(1, len(self.options['classes'][klass]['subclasses']))),
+                'background': random.randrange(len(self.options['backgrounds'])), 'version': self.options['version']}
+        resp = self.session.post(f"{self.target}/autochar", data=form, headers={'Accept': 'application/json'})
+        if resp.status_code != 202:
+            return f"autochar HTTP {resp.status_code}"
+        status_url = resp.json()['status_url']
+        deadline = time.monotonic() + JOB_TIMEOUT
+        while time.monotonic() < deadline:
+            job = self.session.get(status_url).json()
+            if job['status'] == 'done':
+                with self.lock:
+                    self.characters.append(job['url'])
+                return None
+            if job['status'] == 'failed':
+                return f"autochar failed: {job['error']}"
+            time.sleep(0.2)
+        return "autochar job timed out"
+
+    def spellbook(self, key):
+        with self.lock:
+            url = random.choice(self.characters)
+        spells = [{'index': i} for i in random.sample(range(self.num_spells), min(10, self.num_spells))]
+        resp = self.session.post(f"{self.target}/spellbook", json={'apiKey': key, 'charURL': url, 'spells': spells})
+        if resp.status_code != 200:
+            return f"spellbook HTTP {resp.status_code}"
+        data = resp.json()
+        return None if data['success'] else f"spellbook failed: {data['error']}"
+
+    def one(self, _):
+        key = random.choice(self.keys)
+        kind = 'spellbook' if self.characters and random.random() < self.spellbook_ratio else 'autochar'
+        start = time.monotonic()
+        try:
+            error = getattr(self, kind)(key)
+        except requests.RequestException as e:
+            error = f"{kind} {type(e).__name__}"
+        elapsed = time.monotonic() - start
+        with self.lock:
+            self.latencies[kind].append(elapsed)
+            if error:
+                self.errors[error[:120]] += 1
+
+    def run(self, total, concurrency):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(self.one, range(total)))
+        return time.monotonic() - start
+
+    def report(self, elapsed):
+        total = sum(len(v) for v in self.latencies.values())
+        print(f"{total} requests in {elapsed:.1f}s ({total / elapsed:.2f} req/s)")
+        for kind, values in sorted(self.latencies.items()):
+            print(f"  {kind:<10} n={len(values):<5} p50={percentile(values, 0.5) * 1000:.0f}ms "
+                  f"p99={percentile(values, 0.99) * 1000:.0f}ms max={max(values) * 1000:.0f}ms")
+        print(f"errors: {sum(self.errors.values())}")
+        for error, count in self.errors.most_common():
+            print(f"  {count:>5}  {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests web.py against a fake Dicecloud.")
+    parser.add_argument('--target', default='http://127.0.0.1:8000')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--spellbook-ratio', type=float, default=0.5)
+    parser.add_argument('--keys', type=int, default=3, help="Number of distinct API keys to spread traffic over.")
+    args = parser.parse_args()
+
+    driver = Driver(args.target, args.keys, args.spellbook_ratio)
+    elapsed = driver.run(args.requests, args.concurrency)
+    driver.report(elapsed)
+
+
+if __name__ == '__main__':
+    main()
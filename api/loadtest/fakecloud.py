@@ -0,0 +1,131 @@
+"""
+A local stand-in for the parts of the Dicecloud v1 API that DicecloudHTTP uses, for load testing. Run from the api
+directory, then point the app at it with DICECLOUD_API_BASE=http://127.0.0.1:8001:
+
+    python -m loadtest.fakecloud [--port 8001] [--latency 0.1] [--jitter 0.05] [--error-rate 0.01]
+                                 [--rate-limit 20] [--window 10]
+"""
+import argparse
+import itertools
+import random
+import threading
+import time
+
+from flask import Flask, abort, jsonify, request
+
+app = Flask(__name__)
+config = argparse.Namespace(latency=0, jitter=0, error_rate=0, rate_limit=0, window=10)
+
+_ids = itertools.count(1)
+_lock = threading.Lock()
+characters = {}  # id -> character document
+windows = {}  # api key -> (window start, requests in window)
+stats = {'requests': 0, 'errors': 0, 'rate_limited': 0}
+
+
+def new_id():
+    return f"fake{next(_ids)}"
+
+
+@app.before_request
+def simulate():
+    key = request.headers.get('Authorization') or request.args.get('key')
+    with _lock:
+        stats['requests'] += 1
+        if config.rate_limit:
+            now = time.monotonic()
+            start, count = windows.get(key, (now, 0))
+            if now - start >= config.window:
+                start, count = now, 0
+            windows[key] = (start, count + 1)
+            if count >= config.rate_limit:
+                stats['rate_limited'] += 1
+                return jsonify(int((start + config.window - now) * 1000)), 429
+    time.sleep(max(0, random.gauss(config.latency, config.jitter)))
+    if random.random() < config.error_rate:
+        with _lock:
+            stats['errors'] += 1
+        return jsonify({'error': 'simulated failure'}), 500
+
+
+@app.route('/api/character', methods=["POST"])
+def create_character():
+    char_id = new_id()
+    with _lock:
+        characters[char_id] = dict(request.get_json(), _id=char_id, spellLists=[{'_id': new_id(), 'name': 'Spells'}],
+                                   spells=[], features=[], effects=[], proficiencies=[], classes=[])
+    return jsonify({'id': char_id})
+
+
+@app.route('/api/character/<char_id>', methods=["DELETE"])
+def delete_character(char_id):
+    with _lock:
+        if characters.pop(char_id, None) is None:
+            abort(404)
+    return jsonify({})
+
+
+@app.route('/api/character/<char_id>/owner', methods=["PUT"])
+def transfer_ownership(char_id):
+    if char_id not in characters:
+        abort(404)
+    return jsonify({})
+
+
+@app.route('/api/character/<char_id>/<collection>', methods=["POST"])
+def insert(char_id, collection):
+    key = {'feature': 'features', 'effect': 'effects', 'prof': 'proficiencies', 'class': 'classes'}.get(collection)
+    if key is None or char_id not in characters:
+        abort(404)
+    docs = request.get_json()
+    ids = [new_id() for _ in docs]
+    with _lock:
+        characters[char_id][key].extend(dict(doc, _id=i) for doc, i in zip(docs, ids))
+    return jsonify(ids)
+
+
+@app.route('/api/character/<char_id>/spellList/<list_id>', methods=["POST"])
+def insert_spells(char_id, list_id):
+    char = characters.get(char_id)
+    if char is None or not any(l['_id'] == list_id for l in char['spellLists']):
+        abort(404)
+    docs = request.get_json()
+    ids = [new_id() for _ in docs]
+    with _lock:
+        char['spells'].extend(dict(doc, _id=i, parent={'id': list_id}) for doc, i in zip(docs, ids))
+    return jsonify(ids)
+
+
+@app.route('/character/<char_id>/json', methods=["GET"])
+def get_character(char_id):
+    if char_id not in characters:
+        abort(404)
+    return jsonify(characters[char_id])
+
+
+@app.route('/api/user', methods=["GET"])
+def get_user():
+    return jsonify({'id': f"user-{request.args.get('username')}"})
+
+
+@app.route('/stats', methods=["GET"])
+def get_stats():
+    return jsonify(dict(stats, characters=len(characters)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a fake Dicecloud API.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.1, help="Mean seconds added to each response.")
+    parser.add_argument('--jitter', type=float, default=0.05, help="Standard deviation of the added latency.")
+    parser.add_argument('--error-rate', type=float, default=0, help="Fraction of requests that return a 500.")
+    parser.add_argument('--rate-limit', type=int, default=0, help="Requests per API key per window (0 = no limit).")
+    parser.add_argument('--window', type=float, default=10, help="Rate limit window, in seconds.")
+    args = parser.parse_args()
+    vars(config).update(vars(args))
+    app.run(args.host, args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
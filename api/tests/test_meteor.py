@@ -0,0 +1,133 @@
+"""
+Tests MeteorConnection against a scripted fake of the Meteor client, standing in for the socket. Run from the api
+directory: python -m unittest tests.test_meteor
+"""
+import threading
+import unittest
+from unittest import mock
+
+from lib.dicecloud import meteor
+from lib.dicecloud.errors import LoginFailure
+
+PASSWORD = b'hunter2'
+DELAY = 0.01  # seconds before the fake server answers
+
+
+class FakeEmitter:
+    def __init__(self):
+        self.handlers = {}
+
+    def on(self, event, handler):
+        self.handlers.setdefault(event, []).append(handler)
+
+    def emit(self, event, *args):
+        for handler in self.handlers.get(event, []):
+            handler(*args)
+
+
+class FakeMeteorClient(FakeEmitter):
+    """Answers connect, login and method calls from a timer thread, like the real client's socket thread."""
+
+    def __init__(self, url, debug=False):
+        super().__init__()
+        self.ddp_client = FakeEmitter()
+        self.logins = 0
+        self.relogin_ok = True
+
+    @staticmethod
+    def later(func, *args):
+        threading.Timer(DELAY, func, args).start()
+
+    def connect(self):
+        self.later(self.emit, 'connected')
+
+    def login(self, user, password, callback=None):
+        self.logins += 1
+
+        def answer():
+            if password != PASSWORD:
+                callback('403 Incorrect password', None)
+                return
+            callback(None, {'id': 'user-id', 'token': 'token'})
+            self.emit('logged_in', {'id': 'user-id', 'token': 'token'})
+
+        self.later(answer)
+
+    def call(self, method, params, callback=None):
+        self.later(callback, None, {'method': method, 'params': params})
+
+    # ==== scripted socket events ====
+    def drop(self):
+        self.emit('closed', 1006, 'connection lost')
+
+    def reconnect(self):
+        """The socket comes back; the real client then logs back in with its stored credentials."""
+        self.ddp_client.emit('reconnected')
+        if self.relogin_ok:
+            self.emit('logged_in', {'id': 'user-id', 'token': 'token'})
+
+
+class MeteorConnectionTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(meteor, 'MeteorClient', FakeMeteorClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        meteor._connections_pid = None
+
+    def test_concurrent_callers_share_one_login(self):
+        conn = meteor.get_connection('user', PASSWORD)
+        threads = [threading.Thread(target=conn.wait_ready, args=(1,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(conn.logged_in)
+        self.assertEqual(conn.user_id, 'user-id')
+        self.assertEqual(conn.client.logins, 1)
+
+    def test_connections_are_keyed_by_credentials(self):
+        conn = meteor.get_connection('user', PASSWORD)
+        self.assertIs(meteor.get_connection('user', PASSWORD), conn)
+        self.assertIsNot(meteor.get_connection('user', b'wrong'), conn)
+
+    def test_wrong_password_does_not_reuse_a_logged_in_connection(self):
+        meteor.get_connection('user', PASSWORD).wait_ready(1)
+        with self.assertRaises(LoginFailure):
+            meteor.get_connection('user', b'wrong').wait_ready(1)
+
+    def test_failed_login_is_retried(self):
+        conn = meteor.get_connection('user', PASSWORD)
+        conn.password = b'wrong'
+        with self.assertRaises(LoginFailure):
+            conn.wait_ready(1)
+        conn.password = PASSWORD
+        conn.wait_ready(1)
+        self.assertTrue(conn.logged_in)
+        self.assertEqual(conn.client.logins, 2)
+
+    def test_reconnect_logs_back_in(self):
+        conn = meteor.get_connection('user', PASSWORD)
+        conn.wait_ready(1)
+        conn.client.drop()
+        self.assertFalse(conn.logged_in)
+        conn.client.reconnect()
+        conn.wait_ready(1)
+        self.assertEqual(conn.client.logins, 1)
+
+    def test_failed_relogin_after_reconnect_is_retried(self):
+        conn = meteor.get_connection('user', PASSWORD)
+        conn.wait_ready(1)
+        conn.client.drop()
+        conn.client.relogin_ok = False
+        conn.client.reconnect()
+        conn.wait_ready(1)
+        self.assertTrue(conn.logged_in)
+        self.assertEqual(conn.client.logins, 2)
+
+    def test_call_waits_for_login(self):
+        conn = meteor.get_connection('user', PASSWORD)
+        self.assertEqual(conn.call('getCharacter', ['id'], timeout=1), {'method': 'getCharacter', 'params': ['id']})
+
+
+if __name__ == '__main__':
+    unittest.main()
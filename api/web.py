@@ -1,80 +1,447 @@
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import itertools
 import json
 import os
+import time
 import traceback
 
-from flask import Flask, jsonify, redirect, request
+from flask import Flask, Response, g, jsonify, redirect, request, url_for
 from flask_cors import CORS
 
-from dicecloud_tools.autochar import create_char
+from dicecloud_tools.autochar import compile_plan, create_char, plan_cache
+from lib import profiling
 from lib.compendium import c
-from lib.dicecloud.client import DicecloudClient
+from lib.dicecloud.breaker import breaker_stats
+from lib.dicecloud.client import DicecloudClient, character_cache, list_id_cache
+from lib.dicecloud.ratelimit import ratelimit_stats
+from lib.jobs import JobQueue, QueueFull
+from lib.metrics import registry
+from lib.rendering import render_cache
+from lib.search import SpellIndex
+from lib.tracing import current_trace, start_trace
 
 TESTING = True if os.environ.get("TESTING") else False
+SPELL_SEARCH_MAX_LIMIT = 1000
+AUTOCHAR_WORKERS = int(os.environ.get("AUTOCHAR_WORKERS", 4))
+AUTOCHAR_MAX_PENDING = int(os.environ.get("AUTOCHAR_MAX_PENDING", 32))
+AUTOCHAR_BATCH_MAX = int(os.environ.get("AUTOCHAR_BATCH_MAX", 50))
+AUTOCHAR_BATCH_CONCURRENCY = int(os.environ.get("AUTOCHAR_BATCH_CONCURRENCY", 4))  # per batch
+AUTOCHAR_BATCH_WORKERS = int(os.environ.get("AUTOCHAR_BATCH_WORKERS", 8))  # across all batches
+AUTOCHAR_BUDGET = float(os.environ.get("AUTOCHAR_BUDGET", 60))  # seconds of Dicecloud calls per character
+SPELLBOOK_BUDGET = float(os.environ.get("SPELLBOOK_BUDGET", 20))  # seconds of Dicecloud calls per request
+SSE_KEEPALIVE = 15  # seconds between comments on an idle event stream, so proxies don't close it
+SSE_POLL_INTERVAL = 0.5  # seconds between reads of a streamed job's record
 
 app = Flask(__name__)
 CORS(app)
 
+c.preload = ('fancyraces', 'classes', 'backgrounds', 'spells')  # what these routes serve; the rest load on first use
+
+if os.environ.get("PREWARM_RENDER_CACHE"):
+    c.prewarm_render_cache()
+    c.on_swap(lambda compendium: compendium.prewarm_render_cache())
+
+autochar_jobs = JobQueue('autochar', workers=AUTOCHAR_WORKERS, max_pending=AUTOCHAR_MAX_PENDING)
+# runs the characters of /autochar_batch, which are not queued as jobs
+batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=AUTOCHAR_BATCH_WORKERS,
+                                                       thread_name_prefix='autochar-batch')
+
+# ==== metrics ====
+REQUESTS = registry.counter('http_requests_total', "Requests handled, by route and status.",
+                            ('route', 'method', 'status'))
+REQUEST_TIME = registry.histogram('http_request_duration_seconds', "Time taken to handle each request.",
+                                  ('route', 'method'))
+COMPENDIUM_LOAD_TIME = registry.gauge('compendium_load_seconds', "Time taken to load each compendium category.",
+                                      ('category',), mode='max')
+CACHE_HITS = registry.counter('cache_hits_total', "Cache hits.", ('cache',))
+CACHE_MISSES = registry.counter('cache_misses_total', "Cache misses.", ('cache',))
+CACHE_EVICTIONS = registry.counter('cache_evictions_total', "Cache evictions.", ('cache',))
+THROTTLED_TIME = registry.counter('dicecloud_throttled_seconds_total',
+                                  "Time spent waiting on the Dicecloud rate limiter.")
+CIRCUIT_OPEN = registry.gauge('dicecloud_circuit_open', "Whether calls to an upstream are failing fast.", ('upstream',),
+                              mode='max')
+JOBS = registry.gauge('autochar_jobs', "Autochar jobs by status.", ('status',), mode='max')
+JOB_LATENCY = registry.gauge('autochar_job_latency_seconds', "Average autochar job latency, by phase.", ('phase',),
+                             mode='max')
+
+
+@registry.collector
+def collect_stats():
+    for category, seconds in c.load_times.items():
+        COMPENDIUM_LOAD_TIME.set(seconds, category=category)
+    for name, cache in (('render', render_cache), ('plan', plan_cache), ('character', character_cache),
+                        ('list_id', list_id_cache)):
+        CACHE_HITS.set(cache.hits, cache=name)
+        CACHE_MISSES.set(cache.misses, cache=name)
+        CACHE_EVICTIONS.set(cache.evictions, cache=name)
+    THROTTLED_TIME.set(ratelimit_stats()['throttled_seconds'])
+    for upstream, breaker in breaker_stats().items():
+        CIRCUIT_OPEN.set(int(breaker['state'] != 'closed'), upstream=upstream)
+    jobs = autochar_jobs.stats()
+    for status in ('queued', 'running', 'done', 'failed'):
+        JOBS.set(jobs[status], status=status)
+    for phase in ('wait', 'run', 'latency'):
+        JOB_LATENCY.set(jobs[f"avg_{phase}_seconds"] or 0, phase=phase)
+
+
+@app.before_request
+def start_timer():
+    registry.start()
+    c.watch()
+    g.compendium = c.pin()  # the whole request sees one version of the compendium
+    g.start_time = time.perf_counter()
+    start_trace(request.url_rule.rule if request.url_rule is not None else 'unmatched')
+
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    if 'start_time' in g:
+        REQUEST_TIME.observe(time.perf_counter() - g.start_time, route=route, method=request.method)
+    trace = current_trace()
+    if trace is not None:
+        trace.finish(route=route, method=request.method, status=response.status_code)
+        # job status responses carry the job's timings instead
+        response.headers.setdefault('Server-Timing', trace.server_timing())
+        response.headers['Timing-Allow-Origin'] = '*'  # the frontend is on another origin
+    response.headers['X-Compendium-Version'] = c.version
+    return response
+
+
+@app.teardown_request
+def unpin_compendium(exc):
+    if 'compendium' in g:
+        c.unpin(g.pop('compendium'))
+
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    return Response(registry.exposition(), mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/', methods=["GET"])
 def hello_world():
     return 'Hello World!'
 
 
-@app.route('/autochar_options', methods=["GET"])
-def autochar_options():
-    races = [r.name for r in c.fancyraces]
-    backgrounds = [b.name for b in c.backgrounds]
+class CachedJSON:
+    """A JSON payload that is encoded (and gzipped) once, then served with a strong ETag."""
+
+    def __init__(self, data):
+        self.body = json.dumps(data, separators=(',', ':')).encode()
+        self.gzipped = gzip.compress(self.body, 9)
+        digest = hashlib.sha1(self.body).hexdigest()
+        self.etag = digest
+        self.gzip_etag = f"{digest}-gz"
+
+    def response(self):
+        use_gzip = 'gzip' in request.accept_encodings
+        etag = self.gzip_etag if use_gzip else self.etag
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        else:
+            resp = Response(self.gzipped if use_gzip else self.body, mimetype='application/json')
+            if use_gzip:
+                resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag(etag)
+        # revalidated on every use: the payloads hold compendium indices, which a reload can change
+        resp.headers['Cache-Control'] = "no-cache"
+        resp.headers['Vary'] = 'Accept-Encoding'
+        return resp
+
+
+def build_autochar_options(compendium):
+    races = [r.name for r in compendium.fancyraces]
+    backgrounds = [b.name for b in compendium.backgrounds]
     classes = []
 
-    for klass in c.classes:
+    for klass in compendium.classes:
         classes.append({"name": klass['name'], "subclasses": [s['name'] for s in klass['subclasses']]})
 
-    return jsonify({
+    return CachedJSON({
         "races": races,
         "classes": classes,
-        "backgrounds": backgrounds
+        "backgrounds": backgrounds,
+        "version": compendium.version
     })
 
 
+def spell_option(i, spell):
+    return {"name": spell.name, "classes": "".join(spell.classes).lower(), "level": spell.level, "index": i}
+
+
+def build_spell_options(compendium):
+    return CachedJSON({
+        "spells": [spell_option(i, spell) for i, spell in enumerate(compendium.spells)],
+        "version": compendium.version
+    })
+
+
+# rebuilt for each new version of the compendium
+AUTOCHAR_OPTIONS = c.derived(build_autochar_options)
+SPELL_OPTIONS = c.derived(build_spell_options)
+SPELL_INDEX = c.derived(lambda compendium: SpellIndex(compendium.spells))
+
+
+@c.on_swap
+def rebuild_derived(compendium):
+    plan_cache.clear()  # plans hold on to the objects of the compendium they were built from
+    for derived in (AUTOCHAR_OPTIONS, SPELL_OPTIONS, SPELL_INDEX):
+        derived.get()
+
+
+rebuild_derived(c)
+
+
+@app.route('/autochar_options', methods=["GET"])
+def autochar_options():
+    return AUTOCHAR_OPTIONS.get().response()
+
+
+def wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
+
+def parse_build(data):
+    """Returns a character build's (level, race, class, subclass, background) indices from a form or JSON object."""
+    return (int(data.get('level')), int(data.get('race')), int(data.get('class')), int(data.get('subclass')),
+            int(data.get('background')))
+
+
+def stale_options(data):
+    """Whether a request's indices came from options for a compendium version other than the one this request sees."""
+    return data.get('version') != c.version
+
+
+STALE_OPTIONS = "The options on this page have changed since it loaded. Please reload it and try again."
+
+
+def build_args(build):
+    level, race_i, klass_i, subclass_i, background_i = build
+    klass = c.classes[klass_i]
+    return level, c.fancyraces[race_i], klass, klass['subclasses'][subclass_i], c.backgrounds[background_i]
+
+
 @app.route('/autochar', methods=["POST"])
 def autochar():
     data = request.form
     api_key = data.get('apiKey')
     name = data.get('charName')
     try:
-        level = int(data.get('level'))
-        race_i = int(data.get('race'))
-        klass_i = int(data.get('class'))
-        subclass_i = int(data.get('subclass'))
-        background_i = int(data.get('background'))
+        build = parse_build(data)
     except (ValueError, TypeError):
+        if wants_json():
+            return jsonify({"success": False, "error": "MISSING_FIELD"}), 400
         return redirect("https://andrew-zhu.com/dnd/dicecloudtools/autochar.html?error=MISSING_FIELD", code=302)
+    if stale_options(data):
+        if wants_json():
+            return jsonify({"success": False, "error": STALE_OPTIONS}), 409
+        return redirect("https://andrew-zhu.com/dnd/dicecloudtools/autochar.html?error=STALE_OPTIONS", code=302)
+    level, race, klass, subclass, background = build_args(build)
 
-    race = c.fancyraces[race_i]
-    klass = c.classes[klass_i]
-    subclass = klass['subclasses'][subclass_i]
-    background = c.backgrounds[background_i]
+    if g.get('profiling'):  # operator profiling: run the job inside the profiled request, not on the queue
+        char_id = create_char(api_key, name, level, race, klass, subclass, background, budget=AUTOCHAR_BUDGET)
+        return jsonify({"success": True, "url": f"https://dicecloud.com/character/{char_id}"})
 
     try:
-        new_id = create_char(api_key, name, level, race, klass, subclass, background)
-    except Exception as e:
+        job_id = autochar_jobs.submit(functools.partial(create_char, budget=AUTOCHAR_BUDGET),
+                                      api_key, name, level, race, klass, subclass, background)
+    except QueueFull as e:
+        if wants_json():
+            return jsonify({"success": False, "error": str(e)}), 503
         return redirect(f"https://andrew-zhu.com/dnd/dicecloudtools/autochar.html?error={e}", code=302)
 
-    return redirect(f"https://dicecloud.com/character/{new_id}", code=302)
+    if wants_json():
+        return jsonify({"success": True, "job_id": job_id, "status_url": url_for('autochar_status', job_id=job_id,
+                                                                                  _external=True)}), 202
+    return redirect(f"https://andrew-zhu.com/dnd/dicecloudtools/autochar.html?job={job_id}", code=302)
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/autochar_stream', methods=["POST"])
+def autochar_stream():
+    """
+    Queues a character like /autochar, then streams the job's progress as server-sent events instead of leaving the
+    client to poll: a ``stage`` event as each stage starts, then ``done`` with the sheet's URL, or ``error``.
+    The response holds its worker until the character is finished, so this is only for deployments that run threaded
+    or async workers; the autochar page queues with /autochar and polls.
+    """
+    data = request.form
+    api_key = data.get('apiKey')
+    name = data.get('charName')
+    try:
+        build = parse_build(data)
+    except (ValueError, TypeError):
+        return jsonify({"success": False, "error": "MISSING_FIELD"}), 400
+    if stale_options(data):
+        return jsonify({"success": False, "error": STALE_OPTIONS}), 409
+    try:
+        job_id = autochar_jobs.submit(functools.partial(create_char, budget=AUTOCHAR_BUDGET),
+                                      api_key, name, *build_args(build))
+    except QueueFull as e:
+        return jsonify({"success": False, "error": str(e)}), 503
+
+    def generate():
+        stage = None
+        last_sent = time.monotonic()
+        while True:
+            job = autochar_jobs.get(job_id)
+            if job is None:
+                yield sse('error', {"success": False, "error": "No such job."})
+                return
+            if job['status'] == 'done':
+                yield sse('done', {"success": True, "url": f"https://dicecloud.com/character/{job['result']}"})
+                return
+            if job['status'] == 'failed':
+                yield sse('error', {"success": False, "error": job['error']})
+                return
+            if job['stage'] != stage:
+                stage = job['stage']
+                last_sent = time.monotonic()
+                yield sse('stage', {"stage": stage})
+            elif time.monotonic() - last_sent >= SSE_KEEPALIVE:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(SSE_POLL_INTERVAL)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/autochar_batch', methods=["POST"])
+def autochar_batch():
+    """
+    Creates many characters at once. Takes ``{"apiKey": ..., "version": ..., "characters": [...]}``, where the version
+    is the /autochar_options version the indices came from and each character has the same fields as the /autochar
+    form, and streams one JSON line per character as each one finishes.
+    """
+    data = request.get_json()
+    api_key = data.get('apiKey')
+    specs = data.get('characters') or []
+    if stale_options(data):
+        return jsonify({"success": False, "error": STALE_OPTIONS}), 409
+    if len(specs) > AUTOCHAR_BATCH_MAX:
+        error = f"You can create at most {AUTOCHAR_BATCH_MAX} characters at once."
+        return jsonify({"success": False, "error": error}), 400
+
+    results = []  # results that are known before anything runs
+    todo = []  # (index, name, args, plan)
+    resolved = {}  # build -> (args, plan), resolved here against the pinned compendium; identical builds share them
+    for i, spec in enumerate(specs):
+        try:
+            build = parse_build(spec)
+            if build not in resolved:
+                args = build_args(build)
+                resolved[build] = args, compile_plan(*args)
+        except (ValueError, TypeError, IndexError, KeyError, AttributeError) as e:
+            results.append({"index": i, "success": False, "error": f"Invalid character: {e}"})
+            continue
+        todo.append((i, spec.get('charName'), *resolved[build]))
+
+    def run(i, name, args, plan):  # on an executor thread, which has no compendium pinned
+        try:
+            new_id = create_char(api_key, name, *args, plan=plan, budget=AUTOCHAR_BUDGET)
+        except Exception as e:
+            return {"index": i, "success": False, "error": str(e)}
+        return {"index": i, "success": True, "url": f"https://dicecloud.com/character/{new_id}"}
+
+    def generate():
+        for result in results:
+            yield json.dumps(result) + '\n'
+        queued = iter(todo)
+        running = {batch_executor.submit(run, *job) for job in itertools.islice(queued, AUTOCHAR_BATCH_CONCURRENCY)}
+        while running:
+            done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield json.dumps(future.result()) + '\n'
+                job = next(queued, None)
+                if job is not None:
+                    running.add(batch_executor.submit(run, *job))
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/autochar/stats', methods=["GET"])
+def autochar_stats():
+    return jsonify(autochar_jobs.stats())
+
+
+@app.route('/autochar/<job_id>', methods=["GET"])
+def autochar_status(job_id):
+    job = autochar_jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "No such job."}), 404
+    out = {"success": job['status'] != 'failed', "status": job['status'], "stage": job['stage']}
+    if job['status'] == 'done':
+        out['url'] = f"https://dicecloud.com/character/{job['result']}"
+    elif job['status'] == 'failed':
+        out['error'] = job['error']
+    response = jsonify(out)
+    if job['timing']:
+        response.headers['Server-Timing'] = job['timing']
+    return response
+
+
+@app.route('/compendium/version', methods=["GET"])
+def compendium_version():
+    response = jsonify({"version": c.version, "loaded": c.loaded_at})
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 @app.route('/spell_options', methods=["GET"])
 def spell_options():
-    spells = []
-    for i, spell in enumerate(c.spells):
-        spells.append({"name": spell.name, "classes": "".join(spell.classes).lower(), "level": spell.level, "index": i})
+    return SPELL_OPTIONS.get().response()
+
+
+def bool_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def int_arg(name, default=None):
+    """:raises ValueError: if the argument is given (and not empty) but isn't an integer."""
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer.") from None
 
-    return jsonify(spells)
+
+@app.route('/spells/search', methods=["GET"])
+def spell_search():
+    args = request.args
+    try:
+        offset = max(0, int_arg('offset', 0))
+        limit = min(SPELL_SEARCH_MAX_LIMIT, max(0, int_arg('limit', 50)))
+        level = int_arg('level')
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    matches = SPELL_INDEX.get().search(query=args.get('q'), klass=args.get('class'), level=level,
+                                       school=args.get('school'), ritual=bool_arg('ritual'),
+                                       concentration=bool_arg('concentration'))
+    results = [spell_option(i, c.spells[i]) for i in matches[offset:offset + limit]]
+    return jsonify({"success": True, "total": len(matches), "offset": offset, "limit": limit, "results": results,
+                    "version": c.version})
 
 
 @app.route('/spellbook', methods=["POST"])
 def spellbook():
+    """Adds spells to a character. Takes the spells' indices and the version of the search results they came from."""
     data = request.get_json()
+    if stale_options(data):
+        return jsonify({"success": False, "error": STALE_OPTIONS}), 409
     api_key = data.get('apiKey')
     url = data.get('charURL')
     if 'dicecloud.com' in url:
@@ -84,7 +451,7 @@ def spellbook():
         spells = [c.spells[s['index']] for s in spells]
         if not spells:
             raise Exception("You are not inserting any spells.")
-        dc = DicecloudClient(None, None, api_key, no_meteor=True)
+        dc = DicecloudClient(None, None, api_key, no_meteor=True, deadline=time.monotonic() + SPELLBOOK_BUDGET)
         dc.add_spells(url, spells)
     except Exception as e:
         traceback.print_exc()
@@ -92,5 +459,7 @@ def spellbook():
     return jsonify({"success": True, "inserted": len(spells)})
 
 
+profiling.install(app, ('autochar', 'autochar_options', 'spell_options', 'spell_search', 'spellbook'))
+
 if __name__ == '__main__':
     app.run()
@@ -6,7 +6,71 @@ var races, classes, backgrounds;
 const urlParams = new URLSearchParams(window.location.search);
 const error = urlParams.get('error');
 if (error) {
+    if (error === "STALE_OPTIONS") {
+        document.getElementById("error").innerText = "The character options have changed since the page loaded. " +
+            "Please check your choices and try again.";
+    }
+    document.getElementById("error").style.visibility = "visible";
+}
+
+show_error = function (message) {
+    document.getElementById("status").style.visibility = "hidden";
+    document.getElementById("error").innerText = `Failed to create sheet: ${message}`;
     document.getElementById("error").style.visibility = "visible";
+};
+
+// character creation runs in the background; poll its job until it's done
+let job = urlParams.get('job');
+const POLL_LIMIT = 600;  // polls, a second apart, before giving up on a job
+let polls = 0;
+poll_job = function () {
+    $.getJSON(`${API_BASE}/autochar/${job}`, function (data) {
+        let status = document.getElementById("status");
+        if (data.status === "done") {
+            window.location.href = data.url;
+        } else if (data.status === "failed") {
+            show_error(data.error);
+        } else if (++polls >= POLL_LIMIT) {
+            show_error("Your character is taking too long to create. Check Dicecloud before trying again.");
+        } else {
+            status.innerText = `Creating your character (${data.stage})...`;
+            status.style.visibility = "visible";
+            setTimeout(poll_job, 1000);
+        }
+    }).fail(function () {
+        show_error("Lost track of your character. Check Dicecloud before trying again.");
+    });
+};
+if (job) {
+    poll_job();
+}
+
+// where fetch is available, queue the job without leaving the page, then poll it;
+// otherwise the form posts normally and the page polls the job it is redirected with
+queue_autochar = async function (form) {
+    let response = await fetch(`${API_BASE}/autochar`, {
+        method: "POST", body: new FormData(form), headers: {"Accept": "application/json"}
+    });
+    let data = await response.json().catch(() => ({}));
+    if (!response.ok) {
+        show_error(response.status === 400 ? "Make sure all the fields are correct." : data.error);
+        return;
+    }
+    job = data.job_id;
+    polls = 0;
+    poll_job();
+};
+
+if (window.fetch) {
+    document.querySelector("form").addEventListener("submit", function (e) {
+        e.preventDefault();
+        let button = this.querySelector("button[type=submit]");
+        button.disabled = true;  // one submission at a time
+        document.getElementById("error").style.visibility = "hidden";
+        queue_autochar(this)
+            .catch(err => show_error(err.message))
+            .finally(() => button.disabled = false);
+    });
 }
 
 after_load_data = function (data) {
@@ -14,6 +78,8 @@ after_load_data = function (data) {
     races = data.races;
     classes = data.classes;
     backgrounds = data.backgrounds;
+    // sent with the form, so the server can tell if the indices below have since changed
+    document.getElementById("version").value = data.version;
 
     let raceSelect = document.getElementById("race");
     raceSelect.options.length = 0;
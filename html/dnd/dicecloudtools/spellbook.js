@@ -32,7 +32,7 @@ document.getElementById("mode-selector").onclick = function (e) {
 };
 
 // actual spell stuff
-var spells = Array();
+var spells = {};
 var spellsToAdd = Array();
 
 updateToAddList = function () {
@@ -61,14 +61,32 @@ clearToAdd = function () {
 };
 document.getElementById("clear-list-button").onclick = clearToAdd;
 
-// onload, load spell metadata
-$(function () {
-    console.log("Getting data");
-    $.getJSON(`${API_BASE}/spell_options`, function (data) {
-        console.log("Loading data");
-        spells = data;
+// search is done by the API; keep one object per spell so selections survive new searches.
+// spells are identified by their index in the server's compendium, which only holds within one compendium version
+var spellsVersion = null;
+internSpell = function (spell) {
+    if (!(spell.index in spells)) {
+        spells[spell.index] = spell;
+    }
+    return spells[spell.index];
+};
+
+var searchSeq = 0;
+searchSpells = function (params, callback) {
+    let seq = ++searchSeq;
+    $.getJSON(`${API_BASE}/spells/search`, params, function (data) {
+        if (seq === searchSeq) {  // ignore responses to searches that have since changed
+            if (data.version !== spellsVersion) {  // the compendium changed: indices from earlier searches are stale
+                if (spellsVersion !== null) {
+                    clearToAdd();
+                }
+                spells = {};
+                spellsVersion = data.version;
+            }
+            callback(data.results.map(internSpell));
+        }
     });
-});
+};
 
 // single mode handlers
 toggleSingleSpell = function (spell) {
@@ -89,9 +107,10 @@ toggleSingleSpell = function (spell) {
 var searchResults;
 recalcSingleSearch = function () {
     let query = document.getElementById("single-search").value;
-    searchResults = spells.filter(spell =>
-        spell.name.toLowerCase().indexOf(query.toLowerCase()) !== -1
-    );
+    searchSpells({q: query, limit: 50}, showSingleSearch);
+};
+showSingleSearch = function (results) {
+    searchResults = results;
 
     let ul = document.getElementById("single-search-results");
     $(ul).empty();
@@ -113,10 +132,10 @@ document.getElementById("single-search").oninput = recalcSingleSearch;
 recalcMultiSpells = function () {
     let level = +document.getElementById("multi-level").value;
     let klass = document.getElementById("multi-class").value;
-    spellsToAdd = spells.filter(spell =>
-        +spell.level === level && spell.classes.indexOf(klass.toLowerCase()) !== -1
-    );
-    updateToAddList();
+    searchSpells({level: level, class: klass, limit: 1000}, function (results) {
+        spellsToAdd = results;
+        updateToAddList();
+    });
 };
 document.getElementById("multi-level").oninput = recalcMultiSpells;
 document.getElementById("multi-class").oninput = recalcMultiSpells;
@@ -126,7 +145,7 @@ submitForm = function () {
     console.log("submit");
     let apiKey = document.getElementById("apiKey").value;
     let charURL = document.getElementById("url").value;
-    let data = {apiKey: apiKey, charURL: charURL, spells: spellsToAdd};
+    let data = {apiKey: apiKey, charURL: charURL, spells: spellsToAdd, version: spellsVersion};
     console.log(data);
     $.ajax({
         url: `${API_BASE}/spellbook`,
@@ -153,6 +172,15 @@ submitForm = function () {
                 </div>`
             }
             $("body").prepend($(alert));
+        },
+        error: function (xhr) {
+            let message = (xhr.responseJSON && xhr.responseJSON.error) || "Could not reach the server.";
+            $("body").prepend($(`<div class="alert alert-danger alert-dismissible fade show" role="alert">
+                  Failed to insert: ${message}
+                  <button type="button" class="close" data-dismiss="alert" aria-label="Close">
+                    <span aria-hidden="true">&times;</span>
+                  </button>
+                </div>`));
         }
     });
 };